@@ -3,9 +3,10 @@
 import os
 import time
 import signal
-import shutil
+import hashlib
 import requests
 import schedule
+from io import BytesIO
 from PIL import Image
 import RPi.GPIO as GPIO
 from inky.auto import auto
@@ -32,6 +33,11 @@ CITIES = [
 ]
 current_city = CITIES[0]
 
+# Last ETag per URL and hash of the image on the panel, so unchanged frames are skipped
+etags = {}
+shown_image_hash = None
+session = requests.Session()
+
 # Set up RPi.GPIO with the "BCM" numbering scheme
 GPIO.setmode(GPIO.BCM)
 
@@ -40,18 +46,26 @@ GPIO.setmode(GPIO.BCM)
 GPIO.setup(BUTTONS, GPIO.IN, pull_up_down=GPIO.PUD_UP)
 
 def download_image(url):
-    r = requests.get(url, stream=True)
+    # Returns the PNG bytes, or None if the server's image hasn't changed or failed
+    headers = {"If-None-Match": etags[url]} if url in etags else {}
+    r = session.get(url, headers=headers)
+    if r.status_code == 304:
+        print('Image unchanged')
+        return None
     if r.status_code == 200:
-        r.raw.decode_content = True
-        with open("image.png", 'wb') as f:
-            shutil.copyfileobj(r.raw, f)
+        if "ETag" in r.headers:
+            etags[url] = r.headers["ETag"]
         print('Image sucessfully Downloaded')
-    else:
-        print('Image Couldn\'t be retreived')
+        return r.content
+    print('Image Couldn\'t be retreived')
+    return None
 
 def build_url(city):
     api_key = os.environ.get("OWA_API_KEY")
-    url = "https://weatherboard-api-ca.purplemoss-7aaf1984.westeurope.azurecontainerapps.io/?api_key={}&latitude={}&longitude={}&timezone=Europe/Copenhagen".format(api_key, city.latitude, city.longitude)
+    # Ask for an image already at this panel's resolution and quantized to its palette
+    palette = "7color" if inky.colour == "multi" else "3color"
+    width, height = inky.resolution
+    url = "https://weatherboard-api-ca.purplemoss-7aaf1984.westeurope.azurecontainerapps.io/?api_key={}&latitude={}&longitude={}&timezone=Europe/Copenhagen&format=indexed&palette={}&width={}&height={}".format(api_key, city.latitude, city.longitude, palette, width, height)
     return url
 
 # "handle_button" will be called every time a button is pressed
@@ -62,11 +76,21 @@ def handle_button(pin):
     download_and_set_image()
 
 def download_and_set_image():
+    global shown_image_hash
     url = build_url(current_city)
-    download_image(url)
-    image = Image.open("image.png")
-    resizedimage = image.resize(inky.resolution)
-    inky.set_image(resizedimage, saturation=1.0)
+    content = download_image(url)
+    if content is None:
+        return
+    image_hash = hashlib.sha1(content).hexdigest()
+    if image_hash == shown_image_hash:
+        return
+    image = Image.open(BytesIO(content))
+    # Only the Impression (multi-colour) driver takes a saturation argument
+    if inky.colour == "multi":
+        inky.set_image(image, saturation=1.0)
+    else:
+        inky.set_image(image)
+    shown_image_hash = image_hash
     # inky.show()
 
 
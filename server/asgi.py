@@ -0,0 +1,86 @@
+import asyncio
+import logging
+import server
+import metrics
+import asynchttp
+from quart import Quart, Response, request, jsonify
+
+# Optional ASGI mode: upstream waits are coroutines on one event loop instead of held
+# threads, while caches, prefetching and rendering are shared with the WSGI app in server.py
+app = Quart(__name__)
+
+@app.after_serving
+async def close_http_client():
+    await asynchttp.close()
+
+def not_modified(etag, last_modified=None):
+    response = Response("", status=304)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    return response
+
+@app.route("/")
+async def index():
+    # Get API key
+    api_key = request.args.get("api_key")
+    if not api_key:
+        return jsonify({"error": "No query parameter named api_key present"}), 400
+    try:
+        key, composer, style = server.parse_spec(api_key, request.args)
+        # The render cache may read a snapshot from disk, so look it up off the event loop
+        image, status = await asyncio.get_running_loop().run_in_executor(
+            None, server.cached_image, key, api_key, composer, style
+        )
+        if image is None:
+            # Fetch first, so a client that already has this frame is answered without drawing
+            await composer.fetch_async()
+        # Only now is the key known to work, so a bad one never replaces a prefetch key
+        server.prefetcher.register(key, api_key, request.args)
+        if image is None:
+            etag = composer.fingerprint(style)
+            if server.client_is_current(request, etag):
+                logging.info("Served unchanged image for %s" % request.remote_addr)
+                return not_modified(etag)
+            # Drawing is CPU-bound, so keep it off the event loop
+            image = await asyncio.get_running_loop().run_in_executor(
+                None, server.render_cache.refresh, key, lambda: server.draw_image(composer, style)
+            )
+        logging.info("Served %s image for %s" % (status, request.remote_addr))
+        if server.client_is_current(request, image.etag, image.last_modified):
+            response = not_modified(image.etag, image.last_modified)
+        else:
+            response = Response(image.png, mimetype=server.mimetype(style))
+            response.set_etag(image.etag)
+            response.last_modified = image.last_modified
+        response.headers["X-Cache"] = status
+        return response
+    except server.InvalidSpec as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logging.error("Error creating image: %s" % str(e))
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/batch", methods=["POST"])
+async def batch():
+    try:
+        api_key, locations = server.parse_batch(await request.get_json(silent=True), request.args)
+    except server.InvalidSpec as e:
+        return jsonify({"error": str(e)}), 400
+    # Renders on the WSGI app's batch pool, so wait for it in the executor
+    body, mimetype, headers = await asyncio.get_running_loop().run_in_executor(
+        None, server.render_batch, api_key, locations, request.headers.get("Accept", "")
+    )
+    logging.info("Served batch of %i images for %s" % (len(locations), request.remote_addr))
+    return Response(body, mimetype=mimetype, headers=headers)
+
+@app.route("/health")
+async def health():
+    return "OK"
+
+@app.route("/stats")
+async def stats():
+    return jsonify(server.cache_stats())
+
+@app.route("/metrics")
+async def prometheus_metrics():
+    return Response(metrics.exposition(), mimetype=metrics.CONTENT_TYPE)
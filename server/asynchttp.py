@@ -0,0 +1,44 @@
+import os
+import httpx
+from sessions import DEFAULT_TIMEOUT
+
+# One event loop can hold many slow upstream waits, so the pool is much larger than the sync one
+ASYNC_POOL_SIZE = int(os.environ.get("ASYNC_HTTP_POOL_SIZE", "100"))
+
+client = None
+
+
+def async_client() -> httpx.AsyncClient:
+    # Created on first use, inside the serving event loop
+    global client
+    if client is None:
+        client = httpx.AsyncClient(
+            timeout=DEFAULT_TIMEOUT,
+            transport=httpx.AsyncHTTPTransport(
+                retries=2,
+                limits=httpx.Limits(
+                    max_connections=ASYNC_POOL_SIZE, max_keepalive_connections=ASYNC_POOL_SIZE
+                ),
+            ),
+        )
+    return client
+
+
+async def get(url, timeout=None, **kwargs) -> httpx.Response:
+    # Like sessions.session().get, None means the default timeout rather than none at all
+    return await async_client().get(
+        url, timeout=httpx.USE_CLIENT_DEFAULT if timeout is None else timeout, **kwargs
+    )
+
+
+async def post(url, timeout=None, **kwargs) -> httpx.Response:
+    return await async_client().post(
+        url, timeout=httpx.USE_CLIENT_DEFAULT if timeout is None else timeout, **kwargs
+    )
+
+
+async def close():
+    global client
+    if client is not None:
+        await client.aclose()
+        client = None
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""Offline render benchmark.
+
+Replays recorded onecall, geocode and ocean payloads through a stand-in HTTP
+transport and times every stage of the render hot path, cold and warm:
+
+    python bench/bench.py --iterations 50
+
+Peak RSS is the process's high-water mark since start-up, so the warm run can
+only repeat or exceed the cold one; compare traced allocations between them.
+"""
+
+import os
+import sys
+import json
+import time
+import locale
+import argparse
+import resource
+import tempfile
+import functools
+import tracemalloc
+from collections import defaultdict
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FIXTURES = os.path.join(HERE, "fixtures")
+sys.path.insert(0, os.path.dirname(HERE))
+
+# Keep the benchmark away from the real geocode and snapshot caches, and measure icon loading ourselves
+os.environ["GEOCODE_CACHE_PATH"] = os.path.join(tempfile.mkdtemp(), "geocode.sqlite")
+os.environ["SNAPSHOT_DIR"] = ""
+os.environ["ICON_PRELOAD"] = "0"
+
+import requests
+import sessions
+from requests.adapters import BaseAdapter
+
+
+class FixtureAdapter(BaseAdapter):
+    """Answers every upstream request from the recorded payloads, without a network."""
+
+    ROUTES = {
+        "api.openweathermap.org": "onecall.json",
+        "maps.googleapis.com": "geocode.json",
+        "api.weather.kols.dk": "ocean.json",
+    }
+    TIMESTAMPS = ("dt", "sunrise", "sunset", "moonrise", "moonset", "start", "end")
+
+    def __init__(self):
+        super().__init__()
+        self.payloads = {}
+        for host, filename in self.ROUTES.items():
+            with open(os.path.join(FIXTURES, filename), encoding="utf-8") as f:
+                self.payloads[host] = json.load(f)
+        # Shift the recording to the current hour, so "now" lands inside the forecast
+        recorded = self.payloads["api.openweathermap.org"]["current"]["dt"]
+        shift = int(time.time() // 3600 * 3600 - recorded // 3600 * 3600)
+        self.payloads["api.openweathermap.org"] = self.rebase(self.payloads["api.openweathermap.org"], shift)
+        self.bodies = {host: json.dumps(payload).encode() for host, payload in self.payloads.items()}
+
+    def rebase(self, value, shift):
+        if isinstance(value, dict):
+            return {
+                key: item + shift if key in self.TIMESTAMPS and isinstance(item, int) else self.rebase(item, shift)
+                for key, item in value.items()
+            }
+        if isinstance(value, list):
+            return [self.rebase(item, shift) for item in value]
+        return value
+
+    def send(self, request, **kwargs):
+        host = requests.utils.urlparse(request.url).hostname
+        response = requests.Response()
+        response.request = request
+        response.url = request.url
+        response.status_code = 200
+        response.headers["Content-Type"] = "application/json"
+        response._content = self.bodies[host]
+        return response
+
+    def close(self):
+        pass
+
+
+# Must be in place before any thread creates its session
+sessions.adapter = FixtureAdapter()
+
+import palette
+import composer
+import weather
+import locationService
+from composer import ImageComposer
+from weather import WeatherClient
+
+
+class Timings:
+    def __init__(self):
+        self.samples = defaultdict(list)
+
+    def add(self, stage, seconds):
+        self.samples[stage].append(seconds)
+
+    def timed(self, stage, fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - started)
+        return wrapper
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def clear_caches():
+    for cache in (composer.icons, composer.fonts, composer.text_extents, composer.backgrounds,
+                  weather.onecall_cache, weather.summary_cache):
+        cache.clear()
+    locationService.geocode_cache.cities.clear()
+    composer.icon_base_size.cache_clear()
+
+
+# The stages the server exports in weatherboard_render_stage_seconds, plus fetching, parsing and
+# summarising; helpers such as draw_text and draw_icon are left alone, since wrapping calls
+# that small would mostly time the wrapper
+STAGES = [
+    (ImageComposer, "fetch"),
+    (WeatherClient, "load"),
+    (weather, "parse_forecast"),
+    (WeatherClient, "summarise"),
+    (ImageComposer, "draw"),
+    (ImageComposer, "render_background"),
+    (ImageComposer, "draw_date"),
+    (ImageComposer, "draw_city"),
+    (ImageComposer, "draw_uvi"),
+    (ImageComposer, "draw_temps"),
+    (ImageComposer, "draw_column"),
+    (ImageComposer, "draw_meteogram"),
+    (ImageComposer, "draw_stats"),
+    # Where the surface is written out with write_to_png (or quantized)
+    (palette, "encode"),
+]
+
+
+def instrument(timings):
+    """Wrap the top-level stages, returning the originals so they can be restored."""
+    originals = []
+    for owner, name in STAGES:
+        original = getattr(owner, name)
+        originals.append((owner, name, original))
+        stage = name if owner is ImageComposer else f"{owner.__name__}.{name}"
+        setattr(owner, name, timings.timed(stage, original))
+    return originals
+
+
+def run(iterations, cold, options):
+    timings = Timings()
+    originals = instrument(timings)
+    try:
+        for _ in range(iterations):
+            if cold:
+                clear_caches()
+            started = time.perf_counter()
+            image = ImageComposer("benchmark", lat="55.656404", long="12.590530", timezone="Europe/Copenhagen", **options)
+            output = image.render()
+            timings.add("render", time.perf_counter() - started)
+            timings.add("bytes", len(output.getvalue()))
+    finally:
+        for owner, name, original in originals:
+            setattr(owner, name, original)
+    return timings
+
+
+def allocations(cold, options):
+    # A separate pass, since tracing slows everything down
+    if cold:
+        clear_caches()
+    tracemalloc.start()
+    ImageComposer("benchmark", lat="55.656404", long="12.590530", timezone="Europe/Copenhagen", **options).render()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def report(title, timings, peak_alloc, as_json):
+    stages = {}
+    for stage, samples in timings.samples.items():
+        if stage == "bytes":
+            continue
+        stages[stage] = {
+            "calls": len(samples),
+            "p50_ms": percentile(samples, 0.5) * 1000,
+            "p90_ms": percentile(samples, 0.9) * 1000,
+            "p99_ms": percentile(samples, 0.99) * 1000,
+            "total_ms": sum(samples) * 1000,
+        }
+    result = {
+        "title": title,
+        "stages": stages,
+        "output_bytes": timings.samples["bytes"][-1],
+        "peak_alloc_kb": peak_alloc / 1024,
+        # ru_maxrss never goes down, so this is the peak of every run so far, not just this one
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "peak_rss_scope": "process",
+    }
+    if as_json:
+        return result
+
+    print(f"\n== {title} ==")
+    print(f"{'stage':<28}{'calls':>7}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'total ms':>11}")
+    for stage, row in sorted(stages.items(), key=lambda item: -item[1]["total_ms"]):
+        print(f"{stage:<28}{row['calls']:>7}{row['p50_ms']:>10.3f}{row['p90_ms']:>10.3f}{row['p99_ms']:>10.3f}{row['total_ms']:>11.1f}")
+    print(f"output {result['output_bytes']} bytes, peak traced allocations {result['peak_alloc_kb']:.0f} KiB, "
+          f"peak RSS {result['peak_rss_kb']} KiB (process-wide, includes earlier runs)")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=30)
+    parser.add_argument("--format", default="png", choices=palette.FORMATS)
+    parser.add_argument("--palette", default="7color", choices=list(palette.PALETTES))
+    parser.add_argument("--dither", default="none", choices=palette.DITHERS)
+    parser.add_argument("--width", type=int, default=800)
+    parser.add_argument("--height", type=int, default=480)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    try:
+        locale.setlocale(locale.LC_ALL, "da_DK.UTF-8")
+    except locale.Error:
+        print("da_DK.UTF-8 locale missing, day names will differ from production", file=sys.stderr)
+
+    options = {
+        "output": args.format,
+        "colors": args.palette,
+        "dither": args.dither,
+        "width": args.width,
+        "height": args.height,
+    }
+    results = []
+    for title, cold in (("cold caches", True), ("warm caches", False)):
+        peak = allocations(cold, options)
+        results.append(report(title, run(args.iterations, cold, options), peak, args.json))
+    if args.json:
+        print(json.dumps(results, indent=1))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+import threading
+
+MISSING = object()
+
+
+class Cache:
+    """Thread-safe wrapper around a cachetools cache that counts hits and misses."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.backend[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return value
+
+    def peek(self, key, default=None):
+        # Like get, but for housekeeping that shouldn't count towards the hit ratio
+        with self.lock:
+            return self.backend.get(key, default)
+
+    def set(self, key, value):
+        with self.lock:
+            self.backend[key] = value
+
+    def get_or_create(self, key, create):
+        # Creation happens outside the lock, so two threads may race to build
+        # the same value; the last one wins, which is fine for pure values
+        value = self.get(key, MISSING)
+        if value is MISSING:
+            value = create()
+            self.set(key, value)
+        return value
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self.backend),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / total if total else 0,
+            }
+
+    def clear(self):
+        with self.lock:
+            self.backend.clear()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.backend)
@@ -1,11 +1,24 @@
 import os
 import pytz
 import math
+import time
+import json
+import asyncio
 import cairo
+import numpy
+import functools
+import hashlib
+import threading
+import logging
+import metrics
+import palette
 import datetime
 from io import BytesIO
-from weather import WeatherClient
-from typing import List, Tuple, Union
+from cache import Cache
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import LRUCache
+from weather import DaySummary, HourSummary, WeatherClient
+from typing import List, NamedTuple, Tuple, Union
 from locationService import LocationService
 
 
@@ -20,33 +33,287 @@ GREY = (0.4, 0.4, 0.4)
 
 RAIN_COLOR = BLUE
 SNOW_COLOR = LIGHT_BLUE
+# Daylight/UV bar colour by band: dark, daylight, UV 3+, UV 7+
+UV_COLORS = (BLACK, ORANGE, RED, PURPLE)
+
+# The layout is designed at this size and scaled to the requested resolution
+BASE_WIDTH = 800
+BASE_HEIGHT = 480
+MAX_SIZE = 2048
+
+ICON_DIR = os.path.join(os.path.dirname(__file__), "icons")
+ICON_CACHE_SIZE = int(os.environ.get("ICON_CACHE_SIZE", "128"))
+# Optional directory that keeps rasterized icons across restarts
+ICON_CACHE_DIR = os.environ.get("ICON_CACHE_DIR")
+TEXT_CACHE_SIZE = int(os.environ.get("TEXT_CACHE_SIZE", "1024"))
+# Hours the meteogram spans; onecall forecasts 48, later hours repeat the last one
+METEOGRAM_HOURS = int(os.environ.get("METEOGRAM_HOURS", "24"))
+
+# Seconds to wait for each upstream source; only the weather is required to draw
+FETCH_TIMEOUTS = {"weather": 10, "city": 5, "ocean": 5}
+fetcher = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("FETCH_THREADS", "24")), thread_name_prefix="fetch"
+)
+
+FONT_FACES = {
+    "light": cairo.ToyFontFace("Roboto Light"),
+    "bold": cairo.ToyFontFace("Roboto", cairo.FontSlant.NORMAL, cairo.FontWeight.BOLD),
+    "regular": cairo.ToyFontFace("Roboto"),
+}
+
+# Scaled fonts and text measurements, keyed by weight and size plus the transform and font options they were made for
+fonts = Cache(LRUCache(maxsize=64))
+text_extents = Cache(LRUCache(maxsize=TEXT_CACHE_SIZE))
+
+# Rasterized icon surfaces keyed by (icon name, pixel width, pixel height), shared by all renders
+icons = Cache(LRUCache(maxsize=ICON_CACHE_SIZE))
+
+# Pre-rendered static layers keyed by (width, height)
+backgrounds = Cache(LRUCache(maxsize=8))
+
+for name, cache in (("icons", icons), ("fonts", fonts), ("text_extents", text_extents), ("backgrounds", backgrounds)):
+    metrics.register_cache(name, cache)
+
+
+def load_icon(icon: str, scale: float = 1) -> cairo.ImageSurface:
+    width, height = icon_size(icon, scale)
+    return icons.get_or_create((icon, width, height), lambda: rasterize_icon(icon, width, height))
+
+
+@functools.lru_cache(maxsize=None)
+def icon_base_size(icon: str) -> Tuple[int, int]:
+    image = cairo.ImageSurface.create_from_png(os.path.join(ICON_DIR, f"{icon}.png"))
+    return image.get_width(), image.get_height()
+
+
+def icon_size(icon: str, scale: float) -> Tuple[int, int]:
+    # Target pixel size, relative to the PNG export the layout was designed around
+    width, height = icon_base_size(icon)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def rasterize_icon(icon: str, width: int, height: int) -> cairo.ImageSurface:
+    png = os.path.join(ICON_DIR, f"{icon}.png")
+    if (width, height) == icon_base_size(icon):
+        return cairo.ImageSurface.create_from_png(png)
+
+    cached = os.path.join(ICON_CACHE_DIR, f"{icon}-{width}x{height}.png") if ICON_CACHE_DIR else None
+    if cached and os.path.exists(cached):
+        return cairo.ImageSurface.create_from_png(cached)
+
+    svg = os.path.join(ICON_DIR, f"{icon}.svg")
+    if os.path.exists(svg):
+        # Rasterize the vector master at the target size for a sharp icon
+        image = rasterize_svg(svg, width, height)
+    else:
+        image = resample_png(png, width, height)
+
+    if cached:
+        try:
+            os.makedirs(ICON_CACHE_DIR, exist_ok=True)
+            # Write then rename (per thread, as two threads may build the same icon), so no one reads a half-written file
+            partial = f"{cached}.{os.getpid()}.{threading.get_ident()}.tmp"
+            image.write_to_png(partial)
+            os.replace(partial, cached)
+        except OSError as e:
+            logging.warning("Could not write icon cache %s: %s" % (cached, e))
+    return image
+
+
+def rasterize_svg(path: str, width: int, height: int) -> cairo.ImageSurface:
+    import cairosvg
+    png = cairosvg.svg2png(url=path, output_width=width, output_height=height)
+    return cairo.ImageSurface.create_from_png(BytesIO(png))
+
+
+def resample_png(path: str, width: int, height: int) -> cairo.ImageSurface:
+    # Icons without a vector master are resampled once with the best filter
+    image = cairo.ImageSurface.create_from_png(path)
+    scaled = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+    context = cairo.Context(scaled)
+    context.scale(width / image.get_width(), height / image.get_height())
+    context.set_source_surface(image)
+    context.get_source().set_filter(cairo.FILTER_BEST)
+    context.paint()
+    return scaled
+
+
+def font_face(weight: str) -> cairo.ToyFontFace:
+    return FONT_FACES.get(weight, FONT_FACES["regular"])
+
+
+def load_font(weight: str, size: float, ctm=(1, 0, 0, 1), options: cairo.FontOptions = None) -> cairo.ScaledFont:
+    # ctm is the (xx, yx, xy, yy) part of the device transform; translation doesn't affect glyphs
+    options = options or cairo.FontOptions()
+    return fonts.get_or_create(
+        (weight, size, ctm, options.hash()),
+        lambda: cairo.ScaledFont(
+            font_face(weight),
+            cairo.Matrix(xx=size, yy=size),  # the font matrix set_font_size(size) gives a context
+            cairo.Matrix(*ctm, 0, 0),
+            options,
+        ),
+    )
 
-fonts = {}
-icons = {}
+
+def measure_text(context: cairo.Context, text: str, weight: str, size: float) -> Tuple[float, float, float, float]:
+    # x bearing, y bearing, width and height in user space, measured under the context's transform
+    # and font options so hinted widths match what show_text draws
+    matrix = context.get_matrix()
+    ctm = (matrix.xx, matrix.yx, matrix.xy, matrix.yy)
+    options = context.get_target().get_font_options()
+    options.merge(context.get_font_options())
+    return text_extents.get_or_create(
+        (text, weight, size, ctm, options.hash()),
+        lambda: tuple(load_font(weight, size, ctm, options).text_extents(text)[:4]),
+    )
+
+
+def preload_icons():
+    for filename in sorted(os.listdir(ICON_DIR)):
+        if filename.endswith(".png"):
+            load_icon(filename[:-len(".png")])
+
+
+if os.environ.get("ICON_PRELOAD", "1") == "1":
+    preload_icons()
+
+
+class Meteogram(NamedTuple):
+    # One entry per hour offset 0..hours, except where noted
+    x: numpy.ndarray
+    temp: numpy.ndarray
+    rain: numpy.ndarray
+    snow: numpy.ndarray
+    uv_band: numpy.ndarray     # index into UV_COLORS, per hour 0..hours-1
+    day_changes: numpy.ndarray  # hour offsets where the local day changes
+    labels: List[str]           # hour of day, per hour 0..hours-1
 
 
 class ImageComposer:
-    def __init__(self, api_key, lat, long, timezone):
+    def __init__(
+        self,
+        api_key,
+        lat,
+        long,
+        timezone,
+        output="png",
+        colors="7color",
+        dither="none",
+        width=BASE_WIDTH,
+        height=BASE_HEIGHT,
+    ):
         self.api_key = api_key
         self.lat = lat
         self.long = long
-        self.width = 800
-        self.height = 480
+
+        # Render natively at the requested resolution: the layout is scaled uniformly
+        # to fit and centred, rather than the client resizing an 800x480 image
+        self.width = int(width)
+        self.height = int(height)
+        if not (0 < self.width <= MAX_SIZE and 0 < self.height <= MAX_SIZE):
+            raise ValueError("Invalid resolution")
+        self.scale = min(self.width / BASE_WIDTH, self.height / BASE_HEIGHT)
+        self.offset = (
+            round((self.width - BASE_WIDTH * self.scale) / 2),
+            round((self.height - BASE_HEIGHT * self.scale) / 2),
+        )
 
         if timezone not in pytz.all_timezones:
             raise ValueError("Invalid timezone")
         self.timezone = pytz.timezone(timezone)
 
+        # Output encoding: plain PNG, or quantized to an e-paper panel's palette
+        if output not in palette.FORMATS:
+            raise ValueError("Invalid output format")
+        if colors not in palette.PALETTES:
+            raise ValueError("Invalid palette")
+        if dither not in palette.DITHERS:
+            raise ValueError("Invalid dither")
+        self.output = output
+        self.colors = colors
+        self.dither = dither
+
     def render(self):
-        # Fetch weather
+        self.fetch()
+        return self.draw()
+
+    def fetch(self):
+        # Issue every upstream request at once so latency is the slowest one, not the sum
         self.weather = WeatherClient(self.lat, self.long, self.timezone)
-        self.weather.load(self.api_key)
-        # Create image
+        location_service = LocationService(os.environ.get('MAPS_API_KEY'))
+        started = time.monotonic()
+        futures = {
+            "weather": fetcher.submit(self.weather.load, self.api_key, FETCH_TIMEOUTS["weather"]),
+            "city": fetcher.submit(location_service.get_city, self.lat, self.long, FETCH_TIMEOUTS["city"]),
+            "ocean": fetcher.submit(self.weather.ocean_temp, FETCH_TIMEOUTS["ocean"]),
+        }
+        # Without the forecast there is nothing to draw, so let that failure propagate
+        futures["weather"].result(timeout=self.remaining(started, "weather"))
+        self.city = self.fetched(futures, started, "city", default="")
+        self.ocean_temp = self.fetched(futures, started, "ocean", default="N/A")
+
+    async def fetch_async(self):
+        # Same as fetch, but waiting on the shared async HTTP client instead of threads
+        self.weather = WeatherClient(self.lat, self.long, self.timezone)
+        location_service = LocationService(os.environ.get('MAPS_API_KEY'))
+        weather, city, ocean = await asyncio.gather(
+            asyncio.wait_for(self.weather.load_async(self.api_key, FETCH_TIMEOUTS["weather"]), FETCH_TIMEOUTS["weather"]),
+            asyncio.wait_for(location_service.get_city_async(self.lat, self.long, FETCH_TIMEOUTS["city"]), FETCH_TIMEOUTS["city"]),
+            asyncio.wait_for(self.weather.ocean_temp_async(FETCH_TIMEOUTS["ocean"]), FETCH_TIMEOUTS["ocean"]),
+            return_exceptions=True,
+        )
+        # Without the forecast there is nothing to draw, so let that failure propagate
+        if isinstance(weather, BaseException):
+            raise weather
+        self.city = self.fetched_async(city, "city", default="")
+        self.ocean_temp = self.fetched_async(ocean, "ocean", default="N/A")
+
+    def fetched_async(self, result, source, default):
+        if isinstance(result, BaseException):
+            logging.warning("Could not fetch %s, drawing without it: %r" % (source, result))
+            return default
+        return result
+
+    def remaining(self, started, source):
+        return max(0, started + FETCH_TIMEOUTS[source] - time.monotonic())
+
+    def fetched(self, futures, started, source, default):
+        try:
+            return futures[source].result(timeout=self.remaining(started, source))
+        except Exception as e:
+            logging.warning("Could not fetch %s, drawing without it: %r" % (source, e))
+            return default
+
+    def fingerprint(self, *extra) -> str:
+        # Hash of everything the drawing depends on, so equal fingerprints mean equal images
+        now = datetime.datetime.now(self.timezone)
+        snapshot = [
+            self.weather.forecast,
+            self.city,
+            self.ocean_temp,
+            self.lat,
+            self.long,
+            self.timezone.zone,
+            self.width,
+            self.height,
+            self.output,
+            self.colors,
+            self.dither,
+            int(time.time() // 3600),  # hourly lookups move on every (UTC) hour
+            now.strftime("%Y-%m-%d"),   # the date shown is the local one
+            *extra,
+        ]
+        return hashlib.sha1(json.dumps(snapshot, sort_keys=True, default=str).encode()).hexdigest()
+
+    @metrics.timed(metrics.render_seconds, "draw")
+    def draw(self):
+        # Create image, starting from the static layer
         with cairo.ImageSurface(cairo.FORMAT_ARGB32, self.width, self.height) as surface:
             context = cairo.Context(surface)
-            context.rectangle(0, 0, self.width, self.height)
-            context.set_source_rgb(1, 1, 1)
-            context.fill()
+            context.set_source_surface(self.background())
+            context.paint()
+            self.apply_layout(context)
             # Draw features
             self.draw_date(context)                                                     # Draw date
             self.draw_city(context)                                                     # Draw city name
@@ -56,24 +323,75 @@ class ImageComposer:
             self.draw_column(context, self.weather.hourly_summary(2 * 3600), 135, 155)  # Draw conditions in 2 hours
             self.draw_column(context, self.weather.hourly_summary(4 * 3600), 135, 280)  # Draw conditions in 4 hours
             self.draw_column(context, self.weather.hourly_summary(6 * 3600), 135, 405)  # Draw conditions in 6 hours
-            self.draw_vertical_bar(context, 515, 135, 290)                              # Draw vertical bar separating current conditions and forecast
             self.draw_column(context, self.weather.daily_summary(1), 135, 530)          # Draw tomorrow's forecast
             self.draw_column(context, self.weather.daily_summary(2), 135, 655)          # Draw day after tomorrow's forecast
             self.draw_meteogram(context)                                                # Draw meteogram (the graph)
             self.draw_stats(context)                                                    # Draw sunrise, sunset, ocean temperature
             # Save out as bytestream
-            output = BytesIO()
-            surface.write_to_png(output)
-            return output
+            with metrics.timer(metrics.render_seconds, "encode"):
+                return palette.encode(surface, self.output, self.colors, self.dither)
+
+    def apply_layout(self, context: cairo.Context):
+        # Everything after this draws in 800x480 layout coordinates
+        context.translate(*self.offset)
+        context.scale(self.scale, self.scale)
+
+    def background(self) -> cairo.ImageSurface:
+        return backgrounds.get_or_create((self.width, self.height), self.render_background)
+
+    @metrics.timed(metrics.render_seconds, "background")
+    def render_background(self) -> cairo.ImageSurface:
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, self.width, self.height)
+        context = cairo.Context(surface)
+        context.rectangle(0, 0, self.width, self.height)
+        context.set_source_rgb(1, 1, 1)
+        context.fill()
+        self.apply_layout(context)
+        self.draw_background(context)
+        return surface
+
+    def draw_background(self, context: cairo.Context):
+        # Everything drawn here is identical on every render
+        self.draw_icon(context, "uv", (300, 5), 0.7)                    # UV index icon
+        self.draw_roundrect(context, 535, 5, 85, 90, 5)                 # Min. temperature box
+        context.set_source_rgb(*BLUE)
+        context.fill()
+        self.draw_roundrect(context, 710, 5, 85, 90, 5)                 # Max. temperature box
+        context.set_source_rgb(*RED)
+        context.fill()
+        self.draw_text(
+            context,
+            position=(577, 82),
+            text="Min.",
+            color=WHITE,
+            size=23,
+            align="center",
+        )
+        self.draw_text(
+            context,
+            position=(665, 82),
+            text="Nu",
+            color=BLACK,
+            size=23,
+            align="center",
+        )
+        self.draw_text(
+            context,
+            position=(753, 82),
+            text="Max.",
+            color=WHITE,
+            size=23,
+            align="center",
+        )
+        self.draw_vertical_bar(context, 515, 135, 290)                  # Separates current conditions and forecast
+        self.draw_icon(context, "rise-set", (650, 300))                 # Sunrise/sunset icon
+        self.draw_icon(context, "ocean-temp", (657, 402), scaleFactor=0.5)  # Ocean temperature icon
 
-    
+    @metrics.timed(metrics.render_seconds, "city")
     def draw_city(self, context: cairo.Context):
-        location_service = LocationService(os.environ.get('MAPS_API_KEY'))
-        
-        city = location_service.get_city(self.lat, self.long)
         self.draw_text(
             context,
-            text=city,
+            text=self.city,
             position=(5, 125),
             align="left",
             size=30,
@@ -81,6 +399,7 @@ class ImageComposer:
             weight="light",
         )
 
+    @metrics.timed(metrics.render_seconds, "date")
     def draw_date(self, context: cairo.Context):
         now = datetime.datetime.now(self.timezone)
         # Day name
@@ -103,10 +422,10 @@ class ImageComposer:
         )
 
     # TODO make this nicer
+    @metrics.timed(metrics.render_seconds, "uvi")
     def draw_uvi(self, context: cairo.Content):
         left = 500
         max_uvi = self.weather.uvi_max_today()
-        self.draw_icon(context, "uv", (300, 5), 0.7)
 
         self.draw_text(
             context,
@@ -127,17 +446,12 @@ class ImageComposer:
             align="right"
         )
 
+    @metrics.timed(metrics.render_seconds, "temps")
     def draw_temps(self, context: cairo.Context):
         # Draw on temperature ranges
         daily = self.weather.daily_summary(0)
-        temp_min, temp_max = daily["temperature_range"][0], daily["temperature_range"][1]
-        # Draw background rects
-        self.draw_roundrect(context, 535, 5, 85, 90, 5)
-        context.set_source_rgb(*BLUE)
-        context.fill()
-        self.draw_roundrect(context, 710, 5, 85, 90, 5)
-        context.set_source_rgb(*RED)
-        context.fill()
+        temp_min, temp_max = daily.temperature_range
+        # Background rects and labels are part of the static layer
         self.draw_text(
             context,
             position=(577, 55),
@@ -147,14 +461,6 @@ class ImageComposer:
             size=50,
             align="center",
         )
-        self.draw_text(
-            context,
-            position=(577, 82),
-            text="Min.",
-            color=WHITE,
-            size=23,
-            align="center",
-        )
         self.draw_text(
             context,
             position=(665, 55),
@@ -164,14 +470,6 @@ class ImageComposer:
             size=50,
             align="center",
         )
-        self.draw_text(
-            context,
-            position=(665, 82),
-            text="Nu",
-            color=BLACK,
-            size=23,
-            align="center",
-        )
         self.draw_text(
             context,
             position=(753, 55),
@@ -181,70 +479,72 @@ class ImageComposer:
             size=50,
             align="center",
         )
-        self.draw_text(
-            context,
-            position=(753, 82),
-            text="Max.",
-            color=WHITE,
-            size=23,
-            align="center",
+
+    def meteogram_series(self, hours: int) -> Meteogram:
+        # Same lookup as WeatherClient.hourly_summary, for every hour offset at once
+        summaries = self.weather.summaries
+        targets = time.time() + numpy.arange(hours + 1) * 3600
+        index = numpy.searchsorted(self.weather.hourly_times, targets, side="right") - 1
+        index = numpy.clip(index, 0, len(summaries.hourly) - 1)
+
+        temp, rain, snow, uv = summaries.hourly_series[index].T
+        days = summaries.hourly_days[index]
+        return Meteogram(
+            x=numpy.arange(hours + 1, dtype=float),
+            temp=temp,
+            rain=rain,
+            snow=snow,
+            uv_band=((uv != 0).astype(int) + (uv >= 3) + (uv >= 7))[:hours],
+            day_changes=numpy.flatnonzero(days[1:hours] != days[:hours - 1]) + 1,
+            labels=[summaries.hourly[i].hour for i in index[:hours]],
         )
 
+    @metrics.timed(metrics.render_seconds, "meteogram")
     def draw_meteogram(self, context: cairo.Context):
         top = 310
         left = 10
         width = 625
         height = 85
         left_axis = 18
-        hours = 24
+        hours = METEOGRAM_HOURS
         y_interval = 10
         graph_width = width - left_axis
+        # Keep hour labels about as far apart as the 24 hour layout does
+        label_step = 2 * math.ceil(hours / 24)
+
+        series = self.meteogram_series(hours)
 
-        # Establish function that converts hour offset into X
+        # Establish function that converts hour offset into X; works on scalars and arrays alike
         hour_to_x = lambda hour: left + left_axis + (hour * (graph_width / hours))
+        xs = hour_to_x(series.x)
 
         # Draw day boundary lines
-        today = self.weather.hourly_summary(0)["day"]
-        for hour in range(hours):
-            day = self.weather.hourly_summary(hour * 3600)["day"]
-            if day != today:
-                context.save()
-                context.move_to(hour_to_x(hour) - 0.5, top)
-                context.line_to(hour_to_x(hour) - 0.5, top + height)
-                context.set_line_width(1)
-                context.set_source_rgb(*BLACK)
-                context.set_dash([1, 1])
-                context.stroke()
-                context.restore()
-                today = day
+        for hour in series.day_changes:
+            context.save()
+            context.move_to(xs[hour] - 0.5, top)
+            context.line_to(xs[hour] - 0.5, top + height)
+            context.set_line_width(1)
+            context.set_source_rgb(*BLACK)
+            context.set_dash([1, 1])
+            context.stroke()
+            context.restore()
 
         # Establish temperature-to-y function
-        temps = [
-            self.weather.hourly_summary(hour * 3600)["temperature"]
-            for hour in range(hours + 1)
-        ]
-        temp_min = min(temps)
-        temp_max = max(temps)
-        scale_min = math.floor(temp_min / y_interval) * y_interval
-        scale_max = math.ceil(temp_max / y_interval) * y_interval
+        scale_min = int(math.floor(series.temp.min() / y_interval)) * y_interval
+        scale_max = int(math.ceil(series.temp.max() / y_interval)) * y_interval
+        if scale_max == scale_min:
+            # Every temperature on a gridline, e.g. a flat 10°
+            scale_max += y_interval
         temp_to_y = lambda temp: top + (scale_max - temp) * (
             height / (scale_max - scale_min)
         )
 
         # Draw rain/snow curves
-        precip_to_y = lambda precip: top + 1 + (max(4 - precip, 0) * (height / 4))
-        rain_points = []
-        snow_points = []
-        has_rain = False
-        has_snow = False
-        for hour in range(hours + 1):
-            conditions = self.weather.hourly_summary(hour * 3600)
-            if conditions["rain"] > 0:
-                has_rain = True
-            rain_points.append((hour_to_x(hour), precip_to_y(conditions["rain"])))
-            if conditions["snow"] > 0:
-                has_snow = True
-            snow_points.append((hour_to_x(hour), precip_to_y(conditions["snow"])))
+        precip_to_y = lambda precip: top + 1 + (numpy.maximum(4 - precip, 0) * (height / 4))
+        has_rain = bool((series.rain > 0).any())
+        has_snow = bool((series.snow > 0).any())
+        rain_points = list(zip(xs.tolist(), precip_to_y(series.rain).tolist()))
+        snow_points = list(zip(xs.tolist(), precip_to_y(series.snow).tolist()))
         self.draw_precip_curve(
             context, points=rain_points, bottom=int(precip_to_y(0)), color=RAIN_COLOR
         )
@@ -302,12 +602,10 @@ class ImageComposer:
             )
 
         # Draw temperature curve
-        for hour in range(hours + 1):
-            conditions = self.weather.hourly_summary(hour * 3600)
-            if hour == 0:
-                context.move_to(hour_to_x(hour), temp_to_y(conditions["temperature"]))
-            else:
-                context.line_to(hour_to_x(hour), temp_to_y(conditions["temperature"]))
+        temp_points = list(zip(xs.tolist(), temp_to_y(series.temp).tolist()))
+        context.move_to(*temp_points[0])
+        for point in temp_points[1:]:
+            context.line_to(*point)
         context.set_source_rgb(*WHITE)
         context.set_line_width(6)
         context.stroke_preserve()
@@ -318,45 +616,36 @@ class ImageComposer:
         context.set_line_width(3)
         context.stroke()
 
-        # Draw hours and daylight/UV bar
+        # Draw hours
         bar_top = top + height + 13
-        for hour in range(hours + 1):
-            conditions = self.weather.hourly_summary(hour * 3600)
-            x = hour_to_x(hour)
-
-            # Hour label
-            if hour % 2 == 0 and hour < hours:
-                self.draw_text(
-                    context,
-                    text=conditions["hour"]+":00",
-                    position=(x, bar_top + 19),
-                    size=15,
-                    align="center",
-                    valign="bottom",
-                )
+        for hour in range(0, hours, label_step):
+            self.draw_text(
+                context,
+                text=series.labels[hour]+":00",
+                position=(xs[hour], bar_top + 19),
+                size=15,
+                align="center",
+                valign="bottom",
+            )
 
-            # Conditions bar
-            if hour < hours:
-                color = BLACK
-                if conditions["uv"]:
-                    color = ORANGE
-                if conditions["uv"] >= 3:
-                    color = RED
-                if conditions["uv"] >= 7:
-                    color = PURPLE
-                context.rectangle(x, bar_top, (graph_width / hours) + 1, 8)
-                context.set_source_rgb(*color)
-                context.fill()
-
-    def draw_column(self, context: cairo.Context, conditions, top, left):
+        # Draw daylight/UV bar, one rectangle per run of hours in the same band
+        starts = numpy.flatnonzero(numpy.diff(series.uv_band, prepend=-1))
+        ends = numpy.append(starts[1:], hours)
+        for start, end in zip(starts, ends):
+            context.rectangle(xs[start], bar_top, xs[end] - xs[start] + 1, 8)
+            context.set_source_rgb(*UV_COLORS[series.uv_band[start]])
+            context.fill()
+
+    @metrics.timed(metrics.render_seconds, "column")
+    def draw_column(self, context: cairo.Context, conditions: Union[HourSummary, DaySummary], top, left):
         # Heading
-        if "date" in conditions:
+        if isinstance(conditions, DaySummary):
             time_text = (
-                conditions["date"].astimezone(self.timezone).strftime("%A").title()
+                conditions.date.astimezone(self.timezone).strftime("%A").title()
             )
         else:
             time_text = (
-                conditions["time"].astimezone(self.timezone).strftime("%H").lower()
+                conditions.time.astimezone(self.timezone).strftime("%H").lower()
             )
         self.draw_text(
             context,
@@ -366,12 +655,12 @@ class ImageComposer:
             size=28,
             align="center",
         )
-        self.draw_icon(context, conditions["icon"], (left, top + 33))
+        self.draw_icon(context, conditions.icon, (left, top + 33))
 
-        if "temperature" in conditions:
+        if isinstance(conditions, HourSummary):
             self.draw_text(
                 context,
-                text=f"{round(conditions['temperature'])}°",
+                text=f"{round(conditions.temperature)}°",
                 position=(left + 30, top + 150),
                 color=BLACK,
                 size=28,
@@ -379,11 +668,10 @@ class ImageComposer:
                 weight="bold"
             )
 
-        if "wind" in conditions and "wind-icon" in conditions:
-            self.draw_icon(context, conditions["wind-icon"], (left + 40, top + 125), scaleFactor=0.5)
+            self.draw_icon(context, conditions.wind_icon, (left + 40, top + 125), scaleFactor=0.5)
             self.draw_text(
                 context,
-                text=f"{round(conditions['wind'])}",
+                text=f"{round(conditions.wind)}",
                 position=(left + 70, top + 150),
                 color=BLACK,
                 size=28,
@@ -391,10 +679,10 @@ class ImageComposer:
             )
 
         
-        if "temperature_range" in conditions:
+        if isinstance(conditions, DaySummary):
             self.draw_text(
                 context,
-                text=f"{round(conditions['temperature_range'][0])}° • {round(conditions['temperature_range'][1])}°",
+                text=f"{round(conditions.temperature_range[0])}° • {round(conditions.temperature_range[1])}°",
                 position=(left + 50, top + 150),
                 color=BLACK,
                 size=28,
@@ -408,9 +696,9 @@ class ImageComposer:
         context.line_to(x, y2)
         context.stroke()
 
+    @metrics.timed(metrics.render_seconds, "stats")
     def draw_stats(self, context: cairo.Context):
-        # Draw sunrise, sunset, AQI icon and values
-        self.draw_icon(context, "rise-set", (650, 300))
+        # Draw sunrise and sunset values, icons are part of the static layer
         self.draw_text(
             context,
             position=(705, 337),
@@ -427,10 +715,9 @@ class ImageComposer:
         )
 
         # Draw ocean stats
-        self.draw_icon(context, "ocean-temp", (657, 402), scaleFactor=0.5)
         self.draw_text(
             context,
-            text=f'{WeatherClient.ocean_temp(self)}°',
+            text=f'{self.ocean_temp}°',
             position=(705, 430),
             align="left",
             size=30,
@@ -464,17 +751,7 @@ class ImageComposer:
         noop=False,
     ) -> int:
         text = str(text)
-        if weight == "light":
-            context.select_font_face("Roboto Light")
-        elif weight == "bold":
-            context.select_font_face(
-                "Roboto", cairo.FontSlant.NORMAL, cairo.FontWeight.BOLD
-            )
-        else:
-            context.select_font_face("Roboto")
-        context.set_source_rgb(*color)
-        context.set_font_size(size)
-        xbear, ybear, width, height = context.text_extents(text)[:4]
+        xbear, ybear, width, height = measure_text(context, text, weight, size)
         if align == "right":
             x = position[0] - width - xbear
         elif align == "center":
@@ -488,6 +765,9 @@ class ImageComposer:
         else:
             y = position[1]
         if not noop:
+            context.set_font_face(font_face(weight))
+            context.set_font_size(size)
+            context.set_source_rgb(*color)
             context.move_to(x, y)
             context.show_text(text)
         return int(width)
@@ -522,12 +802,12 @@ class ImageComposer:
         context.fill()
 
     def draw_icon(self, context: cairo.Context, icon: str, position: Tuple[int, int], scaleFactor: float = 1):
-        image = cairo.ImageSurface.create_from_png(
-            os.path.join(os.path.dirname(__file__), "icons", f"{icon}.png")
-        )
+        # Icons are rasterized at their final pixel size and blitted without resampling
+        image = load_icon(icon, scaleFactor * self.scale)
+        # Snap the origin to a whole device pixel so cairo copies the pixels instead of resampling
+        x, y = context.user_to_device(*position)
         context.save()
-        context.translate(*position)
-        context.scale(scaleFactor, scaleFactor)
-        context.set_source_surface(image)
+        context.identity_matrix()
+        context.set_source_surface(image, round(x), round(y))
         context.paint()
         context.restore()
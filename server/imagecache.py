@@ -0,0 +1,131 @@
+import os
+import time
+import struct
+import logging
+import threading
+from cache import Cache
+from cachetools import LRUCache
+from snapshots import SnapshotStore
+from singleflight import SingleFlight
+from concurrent.futures import ThreadPoolExecutor
+
+# Images are fresh for the minute bucket they were rendered in, and served stale
+# (while one background render replaces them) for up to RENDER_CACHE_MAX_STALE
+RENDER_CACHE_BUCKET = int(os.environ.get("RENDER_CACHE_BUCKET", "300"))
+RENDER_CACHE_MAX_STALE = int(os.environ.get("RENDER_CACHE_MAX_STALE", "3600"))
+RENDER_CACHE_SIZE = int(os.environ.get("RENDER_CACHE_SIZE", "256"))
+
+FRESH = "HIT"
+STALE = "STALE"
+MISS = "MISS"
+
+
+# Snapshot layout: last_modified, bucket, created, etag length, then the etag and image bytes
+IMAGE_LAYOUT = struct.Struct("<qqdH")
+
+
+class RenderedImage:
+    def __init__(self, png: bytes, etag: str, bucket: int, last_modified: int = None, created: float = None):
+        self.png = png
+        self.etag = etag
+        self.bucket = bucket
+        self.created = created or time.time()
+        # When the frame last changed, which re-renders of an identical image don't move
+        self.last_modified = last_modified or int(self.created)
+
+    def to_bytes(self) -> bytes:
+        etag = self.etag.encode("ascii")
+        header = IMAGE_LAYOUT.pack(self.last_modified, self.bucket, self.created, len(etag))
+        return header + etag + self.png
+
+    @classmethod
+    def from_bytes(cls, payload: bytes) -> "RenderedImage":
+        last_modified, bucket, created, etag_length = IMAGE_LAYOUT.unpack_from(payload)
+        start = IMAGE_LAYOUT.size
+        etag = payload[start:start + etag_length].decode("ascii")
+        if len(etag) != etag_length:
+            raise ValueError("truncated image snapshot")
+        return cls(payload[start + etag_length:], etag, bucket, last_modified, created)
+
+
+class RenderCache:
+    """Finished images keyed by (location, timezone, style), with stale-while-revalidate."""
+
+    def __init__(self, bucket=RENDER_CACHE_BUCKET, max_stale=RENDER_CACHE_MAX_STALE, size=RENDER_CACHE_SIZE):
+        self.bucket_seconds = bucket
+        self.max_stale = max_stale
+        self.entries = Cache(LRUCache(maxsize=size))
+        # Images outlive restarts, so a new replica serves them (stale at worst) straight away
+        self.snapshots = SnapshotStore("render", RenderedImage.to_bytes, RenderedImage.from_bytes)
+        self.lock = threading.Lock()
+        self.refreshing = set()
+        self.flights = SingleFlight()
+        self.refresher = ThreadPoolExecutor(max_workers=2, thread_name_prefix="refresh")
+
+    def bucket(self) -> int:
+        return int(time.time() // self.bucket_seconds)
+
+    def get(self, key, render):
+        """Return (image, FRESH | STALE | MISS), calling render() when needed.
+
+        render() returns (png, etag).
+        """
+        entry, status = self.lookup(key, render)
+        if entry is None:
+            entry = self.refresh(key, render)
+        return entry, status
+
+    def lookup(self, key, render):
+        """Return (image, FRESH | STALE) without rendering in the foreground, or (None, MISS)."""
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.restore(key)
+        if entry is not None:
+            # Entries rendered ahead by the prefetcher belong to the next bucket
+            if entry.bucket >= self.bucket():
+                return entry, FRESH
+            if time.time() - entry.created < self.max_stale:
+                self.revalidate(key, render)
+                return entry, STALE
+        return None, MISS
+
+    def refresh(self, key, render, bucket=None) -> RenderedImage:
+        # Concurrent misses for the same key wait on one render and share it
+        return self.flights.do(key, lambda: self.store(key, render, bucket))
+
+    def store(self, key, render, bucket=None) -> RenderedImage:
+        if bucket is None:
+            bucket = self.bucket()
+        png, etag = render()
+        previous = self.entries.peek(key)
+        last_modified = previous.last_modified if previous is not None and previous.etag == etag else None
+        entry = RenderedImage(png, etag, bucket, last_modified)
+        self.entries.set(key, entry)
+        # Past max_stale an image is never served, so it need not be kept either
+        self.snapshots.set(key, entry, self.max_stale)
+        return entry
+
+    def restore(self, key):
+        snapshot = self.snapshots.get(key)
+        if snapshot is None:
+            return None
+        entry = snapshot[0]
+        self.entries.set(key, entry)
+        return entry
+
+    def revalidate(self, key, render):
+        # At most one background render per key
+        with self.lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+        self.refresher.submit(self.background_refresh, key, render)
+
+    def background_refresh(self, key, render):
+        try:
+            self.refresh(key, render)
+        except Exception as e:
+            logging.error("Error refreshing image for %s: %s" % (key, str(e)))
+        finally:
+            with self.lock:
+                self.refreshing.discard(key)
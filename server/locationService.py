@@ -1,18 +1,129 @@
-import requests
+import os
+import asyncio
+import sqlite3
+import metrics
 import logging
+import threading
+import asynchttp
+from cache import Cache
+from sessions import session
+from singleflight import SingleFlight, AsyncSingleFlight
+from contextlib import closing
+from cachetools import LRUCache, TTLCache
+
+# City names for a coordinate never change, so they are kept on disk across restarts and read back on demand
+GEOCODE_CACHE_PATH = os.environ.get(
+    "GEOCODE_CACHE_PATH", os.path.join(os.path.dirname(__file__), "cache", "geocode.sqlite")
+)
+GEOCODE_CACHE_PRECISION = int(os.environ.get("GEOCODE_CACHE_PRECISION", "3"))
+GEOCODE_CACHE_SIZE = int(os.environ.get("GEOCODE_CACHE_SIZE", "4096"))
+GEOCODE_ERROR_TTL = int(os.environ.get("GEOCODE_ERROR_TTL", "300"))
+
+
+class GeocodeCache:
+    """Reverse-geocode results held in memory and persisted to SQLite."""
+
+    def __init__(self, path):
+        self.path = path
+        self.write_lock = threading.Lock()
+        self.cities = Cache(LRUCache(maxsize=GEOCODE_CACHE_SIZE))
+        # Failed lookups are remembered briefly so a broken key can't cause a request storm
+        self.errors = Cache(TTLCache(maxsize=256, ttl=GEOCODE_ERROR_TTL))
+
+    def connect(self):
+        # Wrap in closing(): sqlite3's own context manager only commits, it never closes
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        connection = sqlite3.connect(self.path)
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS cities (lat REAL, lon REAL, city TEXT, PRIMARY KEY (lat, lon))"
+        )
+        return connection
+
+    def load(self, key):
+        try:
+            with closing(self.connect()) as connection:
+                row = connection.execute("SELECT city FROM cities WHERE lat = ? AND lon = ?", key).fetchone()
+        except (OSError, sqlite3.Error) as e:
+            logging.warning("Could not read geocode cache %s: %s" % (self.path, e))
+            return None
+        if row is not None:
+            self.cities.set(key, row[0])
+            return row[0]
+        return None
+
+    def get(self, key):
+        city = self.cities.get(key)
+        if city is None:
+            city = self.load(key)
+        return city
+
+    def set(self, key, city):
+        self.cities.set(key, city)
+        try:
+            with self.write_lock, closing(self.connect()) as connection, connection:
+                connection.execute("INSERT OR REPLACE INTO cities VALUES (?, ?, ?)", (*key, city))
+        except (OSError, sqlite3.Error) as e:
+            logging.warning("Could not write geocode cache %s: %s" % (self.path, e))
+
+
+geocode_cache = GeocodeCache(GEOCODE_CACHE_PATH)
+geocode_flights = SingleFlight()
+geocode_async_flights = AsyncSingleFlight()
+metrics.register_cache("geocode", geocode_cache.cities)
+metrics.register_cache("geocode_errors", geocode_cache.errors)
+
 
 class LocationService:
     def __init__(self, api_key):
         self.api_key = api_key
 
-    
-    def get_city(self, lat, lon):
-        url = f'https://maps.googleapis.com/maps/api/geocode/json?latlng={lat},{lon}&key={self.api_key}'
-        response = requests.get(url).json()
+
+    def get_city(self, lat, lon, timeout=None):
+        key = self.cache_key(lat, lon)
+        cached = self.cached(key)
+        if cached is not None:
+            return cached
+        return geocode_flights.do(key, lambda: self.lookup(key, timeout))
+
+    async def get_city_async(self, lat, lon, timeout=None):
+        key = self.cache_key(lat, lon)
+        cached = self.cached(key, disk=False)
+        if cached is None:
+            # SQLite blocks, so it is read (and written, in parse) off the event loop
+            cached = await asyncio.get_running_loop().run_in_executor(None, geocode_cache.load, key)
+        if cached is not None:
+            return cached
+        return await geocode_async_flights.do(key, lambda: self.lookup_async(key, timeout))
+
+    def cache_key(self, lat, lon):
+        return (round(float(lat), GEOCODE_CACHE_PRECISION), round(float(lon), GEOCODE_CACHE_PRECISION))
+
+    def cached(self, key, disk=True):
+        # Recent failures first, so a failing key doesn't go to disk on every render
+        error = geocode_cache.errors.get(key)
+        if error is not None:
+            return error
+        return geocode_cache.get(key) if disk else geocode_cache.cities.get(key)
+
+    def url(self, key):
+        return f'https://maps.googleapis.com/maps/api/geocode/json?latlng={key[0]},{key[1]}&key={self.api_key}'
+
+    @metrics.timed(metrics.upstream_seconds, "geocode")
+    def lookup(self, key, timeout):
+        return self.parse(key, session().get(self.url(key), timeout=timeout).json())
+
+    @metrics.timed_async(metrics.upstream_seconds, "geocode")
+    async def lookup_async(self, key, timeout):
+        response = (await asynchttp.get(self.url(key), timeout=timeout)).json()
+        return await asyncio.get_running_loop().run_in_executor(None, self.parse, key, response)
+
+    def parse(self, key, response):
         if response['status'] != 'OK':
-            logging.error("Something went wrong with Google Maps API. Error: %s" % response['error_message'])
-            return response['error_message']
-        
+            error = response.get('error_message', response['status'])
+            logging.error("Something went wrong with Google Maps API. Error: %s" % error)
+            geocode_cache.errors.set(key, error)
+            return error
+
         city = ''
         for result in response['results']:
             for component in result['address_components']:
@@ -22,4 +133,5 @@ class LocationService:
             if city:
                 break
 
-        return city
\ No newline at end of file
+        geocode_cache.set(key, city)
+        return city
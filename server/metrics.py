@@ -0,0 +1,123 @@
+import time
+import bisect
+import functools
+import threading
+from contextlib import contextmanager
+
+# Upper bounds in seconds, from cached lookups to slow upstream calls
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Histogram:
+    """Prometheus histogram with a single label."""
+
+    def __init__(self, name, help, label, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # label value -> [per-bucket counts..., +Inf count], sum
+        self.counts = {}
+        self.sums = {}
+        # (value, seconds) pairs collected by recording(), or None
+        self.recorded = None
+
+    def observe(self, value, seconds):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            counts = self.counts.setdefault(value, [0] * (len(self.buckets) + 1))
+            counts[index] += 1
+            self.sums[value] = self.sums.get(value, 0) + seconds
+            if self.recorded is not None:
+                self.recorded.append((value, seconds))
+
+    @contextmanager
+    def recording(self):
+        """Collect this block's observations, to be replayed into another process's histogram.
+
+        Meant for single-threaded render workers: observations from other threads are collected too.
+        """
+        self.recorded = recorded = []
+        try:
+            yield recorded
+        finally:
+            self.recorded = None
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for value, counts in sorted(self.counts.items()):
+                label = f'{self.label}="{value}"'
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}')
+                cumulative += counts[-1]
+                lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {cumulative}')
+                lines.append(f"{self.name}_sum{{{label}}} {self.sums[value]}")
+                lines.append(f"{self.name}_count{{{label}}} {cumulative}")
+        return lines
+
+
+upstream_seconds = Histogram(
+    "weatherboard_upstream_seconds", "Latency of upstream requests.", "source"
+)
+render_seconds = Histogram(
+    "weatherboard_render_stage_seconds", "Latency of render stages.", "stage"
+)
+histograms = [upstream_seconds, render_seconds]
+
+# name -> cache.Cache, exported as hit/miss counters and a hit ratio
+caches = {}
+
+
+def register_cache(name, cache):
+    caches[name] = cache
+
+
+@contextmanager
+def timer(histogram, value):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(value, time.perf_counter() - started)
+
+
+def timed(histogram, value):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timer(histogram, value):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def timed_async(histogram, value):
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with timer(histogram, value):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def exposition() -> str:
+    lines = []
+    for histogram in histograms:
+        lines += histogram.expose()
+    stats = {name: cache.stats() for name, cache in sorted(caches.items())}
+    for metric, key, kind, help in (
+        ("weatherboard_cache_hits_total", "hits", "counter", "Cache hits."),
+        ("weatherboard_cache_misses_total", "misses", "counter", "Cache misses."),
+        ("weatherboard_cache_hit_ratio", "hit_ratio", "gauge", "Cache hits over lookups."),
+        ("weatherboard_cache_entries", "size", "gauge", "Entries held by the cache."),
+    ):
+        lines += [f"# HELP {metric} {help}", f"# TYPE {metric} {kind}"]
+        lines += [f'{metric}{{cache="{name}"}} {values[key]}' for name, values in stats.items()]
+    return "\n".join(lines) + "\n"
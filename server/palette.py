@@ -0,0 +1,86 @@
+import sys
+import cairo
+import numpy
+from io import BytesIO
+from PIL import Image
+
+# Index order matches the Inky drivers, so indexed output can go straight to inky.set_image
+PALETTES = {
+    "7color": [
+        (0, 0, 0),        # black
+        (255, 255, 255),  # white
+        (0, 255, 0),      # green
+        (0, 0, 255),      # blue
+        (255, 0, 0),      # red
+        (255, 255, 0),    # yellow
+        (255, 140, 0),    # orange
+    ],
+    "3color": [
+        (255, 255, 255),  # white
+        (0, 0, 0),        # black
+        (255, 0, 0),      # red
+    ],
+}
+FORMATS = ("png", "indexed", "raw")
+DITHERS = ("none", "ordered", "floyd-steinberg")
+
+# 4x4 Bayer thresholds centred on zero, and how far they may push a channel
+BAYER = (numpy.array([[0, 8, 2, 10], [12, 4, 14, 6], [3, 11, 1, 9], [15, 7, 13, 5]]) + 0.5) / 16 - 0.5
+ORDERED_SPREAD = 96
+
+
+def encode(surface: cairo.ImageSurface, output="png", palette="7color", dither="none") -> BytesIO:
+    result = BytesIO()
+    if output == "png":
+        surface.write_to_png(result)
+        return result
+    indices = quantize(surface_to_rgb(surface), palette, dither)
+    if output == "indexed":
+        image = Image.fromarray(indices, mode="P")
+        image.putpalette([channel for color in PALETTES[palette] for channel in color])
+        image.save(result, format="PNG", optimize=True)
+    else:
+        result.write(pack(indices, palette))
+    return result
+
+
+def surface_to_rgb(surface: cairo.ImageSurface) -> numpy.ndarray:
+    surface.flush()
+    width, height = surface.get_width(), surface.get_height()
+    pixels = numpy.ndarray(
+        shape=(height, surface.get_stride() // 4, 4), dtype=numpy.uint8, buffer=surface.get_data()
+    )[:, :width]
+    # ARGB32 is a native-endian 32-bit word: BGRA bytes on little-endian machines.
+    # Frames are drawn onto an opaque background, so premultiplication can be ignored
+    channels = [2, 1, 0] if sys.byteorder == "little" else [1, 2, 3]
+    return pixels[:, :, channels]
+
+
+def quantize(rgb: numpy.ndarray, palette: str, dither: str) -> numpy.ndarray:
+    colors = PALETTES[palette]
+    if dither == "ordered":
+        height, width = rgb.shape[:2]
+        threshold = numpy.tile(BAYER, (height // 4 + 1, width // 4 + 1))[:height, :width]
+        rgb = numpy.clip(rgb + threshold[:, :, None] * ORDERED_SPREAD, 0, 255).astype(numpy.uint8)
+    # Pillow wants a full 256 entry palette; repeating ours means index % len(colors) is the colour
+    palette_image = Image.new("P", (1, 1))
+    palette_image.putpalette([channel for i in range(256) for channel in colors[i % len(colors)]])
+    image = Image.fromarray(numpy.ascontiguousarray(rgb), mode="RGB").quantize(
+        palette=palette_image,
+        dither=Image.Dither.FLOYDSTEINBERG if dither == "floyd-steinberg" else Image.Dither.NONE,
+    )
+    return (numpy.asarray(image) % len(colors)).astype(numpy.uint8)
+
+
+def pack(indices: numpy.ndarray, palette: str) -> bytes:
+    flat = indices.flatten()
+    if palette == "7color":
+        # Inky Impression: two 4-bit pixels per byte, first pixel in the high nibble;
+        # an odd pixel count leaves the last low nibble as zero padding
+        if flat.size % 2:
+            flat = numpy.append(flat, numpy.uint8(0))
+        return (((flat[::2] << 4) & 0xF0) | (flat[1::2] & 0x0F)).astype(numpy.uint8).tobytes()
+    # Inky wHAT/pHAT: a 1-bit black plane (0 = black) followed by a 1-bit red plane (1 = red)
+    black = numpy.packbits(numpy.where(flat == 1, 0, 1).astype(numpy.uint8))
+    red = numpy.packbits(numpy.where(flat == 2, 1, 0).astype(numpy.uint8))
+    return black.tobytes() + red.tobytes()
@@ -0,0 +1,140 @@
+import os
+import time
+import random
+import logging
+import snapshots
+import threading
+from datetime import datetime, timedelta
+from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.executors.pool import ThreadPoolExecutor
+
+# Re-render hot locations this many seconds before their cached image goes stale,
+# spread over PREFETCH_JITTER seconds and at most PREFETCH_CONCURRENCY at a time
+PREFETCH_INTERVAL = int(os.environ.get("PREFETCH_INTERVAL", "30"))
+PREFETCH_LEAD = int(os.environ.get("PREFETCH_LEAD", "60"))
+PREFETCH_JITTER = int(os.environ.get("PREFETCH_JITTER", "20"))
+PREFETCH_CONCURRENCY = int(os.environ.get("PREFETCH_CONCURRENCY", "2"))
+PREFETCH_MAX_LOCATIONS = int(os.environ.get("PREFETCH_MAX_LOCATIONS", "64"))
+# Configured locations count towards PREFETCH_MAX_LOCATIONS too; any beyond it are ignored.
+# Locations learned from traffic are dropped after this many seconds without a request
+PREFETCH_IDLE = int(os.environ.get("PREFETCH_IDLE", "3600"))
+# Always-hot locations as "lat,lon,timezone;lat,lon,timezone", rendered with PREFETCH_API_KEY
+PREFETCH_LOCATIONS = os.environ.get("PREFETCH_LOCATIONS", "")
+PREFETCH_API_KEY = os.environ.get("PREFETCH_API_KEY")
+
+
+class HotLocation:
+    def __init__(self, api_key, args, configured=False):
+        self.api_key = api_key
+        self.args = args
+        self.configured = configured
+        self.last_seen = time.time()
+
+
+class Prefetcher:
+    """Keeps a registry of hot locations and renders them ahead of cache expiry."""
+
+    def __init__(self, render_cache, build, render):
+        # build(api_key, args) -> (key, composer, style); render(composer, style) -> render result
+        self.render_cache = render_cache
+        self.build = build
+        self.render = render
+        self.lock = threading.Lock()
+        self.locations = {}
+        self.refreshes = 0
+        self.failures = 0
+        self.scheduler = BackgroundScheduler(
+            executors={"default": ThreadPoolExecutor(PREFETCH_CONCURRENCY)},
+            job_defaults={"coalesce": True, "max_instances": 1, "misfire_grace_time": PREFETCH_LEAD},
+            daemon=True,
+        )
+
+    def register(self, key, api_key, args, configured=False):
+        # Requests register only after their key has been served from, or accepted by, OpenWeatherMap
+        with self.lock:
+            location = self.locations.get(key)
+            if location is not None:
+                location.last_seen = time.time()
+                location.api_key = api_key
+                return
+            if len(self.locations) >= PREFETCH_MAX_LOCATIONS:
+                self.forget_oldest()
+            if len(self.locations) >= PREFETCH_MAX_LOCATIONS:
+                # Every slot holds a configured location, which are never evicted
+                if configured:
+                    logging.warning("Too many prefetch locations, ignoring %s" % (key,))
+                return
+            self.locations[key] = HotLocation(api_key, dict(args), configured)
+
+    def forget_oldest(self):
+        learned = [key for key, location in self.locations.items() if not location.configured]
+        if learned:
+            del self.locations[min(learned, key=lambda key: self.locations[key].last_seen)]
+
+    def configure(self, locations=PREFETCH_LOCATIONS, api_key=PREFETCH_API_KEY):
+        for spec in filter(None, locations.split(";")):
+            lat, lon, timezone = spec.strip().split(",")
+            args = {"latitude": lat, "longitude": lon, "timezone": timezone}
+            try:
+                key = self.build(api_key, args)[0]
+            except Exception as e:
+                logging.error("Invalid prefetch location %s: %s" % (spec, str(e)))
+                continue
+            self.register(key, api_key, args, configured=True)
+
+    def start(self, prefetch=True):
+        # The scheduler also keeps the snapshot directories swept, so it runs with prefetching off too
+        self.scheduler.add_job(
+            snapshots.sweep, "interval", seconds=snapshots.SNAPSHOT_SWEEP_INTERVAL, id="sweep",
+            next_run_time=datetime.now(),
+        )
+        if prefetch:
+            self.configure()
+            self.scheduler.add_job(self.scan, "interval", seconds=PREFETCH_INTERVAL, id="scan")
+        self.scheduler.start()
+
+    def scan(self):
+        now = time.time()
+        bucket = self.render_cache.bucket()
+        bucket_end = (bucket + 1) * self.render_cache.bucket_seconds
+        with self.lock:
+            for key in [key for key, location in self.locations.items()
+                        if not location.configured and now - location.last_seen > PREFETCH_IDLE]:
+                del self.locations[key]
+            hot = list(self.locations.items())
+
+        for key, location in hot:
+            if not location.api_key:
+                continue
+            entry = self.render_cache.entries.peek(key)
+            if entry is not None and entry.bucket > bucket:
+                continue  # Already rendered for the next bucket
+            if entry is not None and entry.bucket == bucket and bucket_end - now > PREFETCH_LEAD:
+                continue  # Fresh, and not about to expire
+            # Missing or stale entries are rendered for the current bucket right away;
+            # ones about to expire are rendered for the next, with jitter
+            ahead = entry is not None and entry.bucket == bucket
+            delay = random.uniform(0, min(PREFETCH_JITTER, max(bucket_end - now - 1, 0))) if ahead else 0
+            self.scheduler.add_job(
+                self.refresh,
+                "date",
+                run_date=datetime.now() + timedelta(seconds=delay),
+                args=[key, location, bucket + 1 if ahead else bucket],
+                id=f"refresh-{key}",
+                replace_existing=True,
+            )
+
+    def refresh(self, key, location, bucket):
+        try:
+            _, composer, style = self.build(location.api_key, location.args)
+            self.render_cache.refresh(key, lambda: self.render(composer, style), bucket=bucket)
+            with self.lock:
+                self.refreshes += 1
+        except Exception as e:
+            with self.lock:
+                self.failures += 1
+            logging.error("Error prefetching image for %s: %s" % (key, str(e)))
+
+    def stats(self):
+        with self.lock:
+            return {"locations": len(self.locations), "refreshes": self.refreshes, "failures": self.failures}
@@ -0,0 +1,55 @@
+import os
+import locale
+import metrics
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# Worker processes for the CPU-bound draw phase; 0 draws in the calling thread
+RENDER_PROCESSES = int(os.environ.get("RENDER_PROCESSES", "0"))
+
+
+def init_worker(time_locale):
+    # Day and month names come from strftime, so workers need the server's locale
+    locale.setlocale(locale.LC_TIME, time_locale)
+
+
+def draw(composer):
+    # Runs in a worker: font, icon and background caches stay warm per process.
+    # Stage timings go back with the image, since only the server's histograms are exported
+    with metrics.render_seconds.recording() as timings:
+        png = composer.draw().getvalue()
+    return png, timings
+
+
+class RenderPool:
+    """Sends fetched composers to worker processes to draw, outside the server's GIL."""
+
+    def __init__(self, processes=RENDER_PROCESSES):
+        self.processes = processes
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        # Started lazily so workers pick up the locale the server set at import
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.processes,
+                    # Forking a threaded server is unsafe, so start clean interpreters
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=init_worker,
+                    initargs=(locale.getlocale(locale.LC_TIME),),
+                )
+        return self.executor
+
+    def draw(self, composer) -> bytes:
+        if not self.processes:
+            return composer.draw().getvalue()
+        png, timings = self.start().submit(draw, composer).result()
+        for stage, seconds in timings:
+            metrics.render_seconds.observe(stage, seconds)
+        return png
+
+
+render_pool = RenderPool()
@@ -1,12 +1,110 @@
+import os
+import json
+import uuid
 import locale
 import logging
+import metrics
+import zipfile
+from io import BytesIO
 from composer import ImageComposer
+from weather import onecall_cache, verified_keys
+from prefetch import Prefetcher
+from imagecache import MISS, RenderCache
+from renderpool import render_pool
+from locationService import geocode_cache
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, send_file, request, jsonify
 
 app = Flask(__name__)
 
 locale.setlocale(locale.LC_ALL, 'da_DK.UTF-8')
 
+BATCH_MAX_LOCATIONS = int(os.environ.get("BATCH_MAX_LOCATIONS", "32"))
+PREFETCH_ENABLED = os.environ.get("PREFETCH_ENABLED", "1") == "1"
+
+render_cache = RenderCache()
+metrics.register_cache("render", render_cache.entries)
+batch_pool = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("BATCH_THREADS", "8")), thread_name_prefix="batch"
+)
+
+class InvalidSpec(ValueError):
+    """Query args or a batch entry the client has to fix; answered with 400."""
+
+def parse_size(args, name, default):
+    try:
+        return int(args.get(name, default))
+    except (TypeError, ValueError):
+        raise InvalidSpec("%s must be a whole number of pixels" % name)
+
+def parse_spec(api_key, args):
+    """Build (cache key, composer, style) from query args or a batch entry."""
+    lat = str(args.get("latitude", "55.656404"))
+    long = str(args.get("longitude", "12.590530"))
+    timezone = args.get("timezone", "Europe/Copenhagen")
+    # Only options the composer actually draws differently belong here: every distinct
+    # style is its own render cache entry, ETag and prefetch job
+    style = (
+        args.get("format", "png"),
+        args.get("palette", "7color"),
+        args.get("dither", "none"),
+        parse_size(args, "width", "800"),
+        parse_size(args, "height", "480"),
+    )
+    try:
+        # Validates the timezone, size and output options before anything is cached under them
+        composer = ImageComposer(
+            api_key,
+            lat=lat,
+            long=long,
+            timezone=timezone,
+            output=style[0],
+            colors=style[1],
+            dither=style[2],
+            width=style[3],
+            height=style[4],
+        )
+        key = ((float(lat), float(long)), timezone, style)
+    except ValueError as e:
+        raise InvalidSpec(str(e))
+    return key, composer, style
+
+def mimetype(style):
+    return "application/octet-stream" if style[0] == "raw" else "image/png"
+
+def render_image(composer, style):
+    composer.fetch()
+    return draw_image(composer, style)
+
+def draw_image(composer, style):
+    png = render_pool.draw(composer)
+    return png, composer.fingerprint(style)
+
+prefetcher = Prefetcher(render_cache, parse_spec, render_image)
+prefetcher.start(prefetch=PREFETCH_ENABLED)
+
+def cached_image(key, api_key, composer, style):
+    # Boards share cached images, but only once OpenWeatherMap has accepted their key;
+    # until then the caller misses, and its own fetch tests the key
+    if api_key not in verified_keys:
+        return None, MISS
+    return render_cache.lookup(key, lambda: render_image(composer, style))
+
+def client_is_current(req, etag, last_modified=None):
+    # Conditional GET as Werkzeug's is_resource_modified does it, shared by the WSGI and ASGI apps:
+    # If-None-Match decides when present, otherwise If-Modified-Since
+    if req.if_none_match:
+        return req.if_none_match.contains_weak(etag)
+    if last_modified is not None and req.if_modified_since is not None:
+        return last_modified <= req.if_modified_since.timestamp()
+    return False
+
+def not_modified(etag, last_modified=None):
+    response = app.response_class(status=304)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    return response
+
 @app.route("/")
 def index():
     # Get API key
@@ -14,22 +112,146 @@ def index():
     if not api_key:
         return jsonify({"error": "No query parameter named api_key present"}), 400
     try:
-        # Render
-        composer = ImageComposer(
-            api_key,
-            lat=request.args.get("latitude", "55.656404"),
-            long=request.args.get("longitude", "12.590530"),
-            timezone=request.args.get("timezone", "Europe/Copenhagen"),
-        )
-        output = composer.render()
-        logging.info("Created image for %s" % request.remote_addr)
-        # Send to client
-        output.seek(0)
-        return send_file(output, mimetype="image/png")
+        key, composer, style = parse_spec(api_key, request.args)
+        image, status = cached_image(key, api_key, composer, style)
+        if image is None:
+            # Fetch first, so a client that already has this frame is answered without drawing
+            composer.fetch()
+        # Only now is the key known to work, so a bad one never replaces a prefetch key
+        prefetcher.register(key, api_key, request.args)
+        if image is None:
+            etag = composer.fingerprint(style)
+            if client_is_current(request, etag):
+                logging.info("Served unchanged image for %s" % request.remote_addr)
+                return not_modified(etag)
+            image = render_cache.refresh(key, lambda: draw_image(composer, style))
+        logging.info("Served %s image for %s" % (status, request.remote_addr))
+        # Send to client, or 304 if its If-None-Match/If-Modified-Since still holds
+        if client_is_current(request, image.etag, image.last_modified):
+            response = not_modified(image.etag, image.last_modified)
+        else:
+            response = send_file(
+                BytesIO(image.png),
+                mimetype=mimetype(style),
+                etag=image.etag,
+                last_modified=image.last_modified,
+            )
+        response.headers["X-Cache"] = status
+        return response
+    except InvalidSpec as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         logging.error("Error creating image: %s" % str(e))
         return jsonify({"error": str(e)}), 500
 
+@app.route("/batch", methods=["POST"])
+def batch():
+    try:
+        api_key, locations = parse_batch(request.get_json(silent=True), request.args)
+    except InvalidSpec as e:
+        return jsonify({"error": str(e)}), 400
+    body, mimetype, headers = render_batch(api_key, locations, request.headers.get("Accept", ""))
+    logging.info("Served batch of %i images for %s" % (len(locations), request.remote_addr))
+    return app.response_class(body, mimetype=mimetype, headers=headers)
+
+def parse_batch(body, args):
+    """Return (api_key, locations) from a batch request body, shared with the ASGI app."""
+    # Body: {"api_key": "...", "locations": [{"latitude": ..., "longitude": ..., "timezone": ..., ...}]}
+    # Each location takes the same options as the query parameters of /
+    body = body if isinstance(body, dict) else {}
+    api_key = body.get("api_key") or args.get("api_key")
+    if not api_key:
+        raise InvalidSpec("No api_key present")
+    locations = body.get("locations")
+    if not isinstance(locations, list) or not locations:
+        raise InvalidSpec("No locations present")
+    if len(locations) > BATCH_MAX_LOCATIONS:
+        raise InvalidSpec("At most %i locations per batch" % BATCH_MAX_LOCATIONS)
+    return api_key, locations
+
+def render_batch(api_key, locations, accept):
+    """Render every location and return (body, mimetype, headers); blocks until all are done."""
+    # Every location fetches and renders concurrently, sharing connection pools and caches
+    results = list(batch_pool.map(lambda location: render_location(api_key, location), locations))
+    if "multipart/mixed" in accept:
+        return multipart_body(results)
+    return zip_body(results)
+
+def render_location(api_key, location):
+    try:
+        key, composer, style = parse_spec(api_key, location)
+        image, status = cached_image(key, api_key, composer, style)
+        if image is None:
+            # Fetch outside the render flight, so an untested key can't ride on another caller's render
+            composer.fetch()
+            image = render_cache.refresh(key, lambda: draw_image(composer, style))
+        prefetcher.register(key, api_key, location)
+        return {"location": location, "image": image, "status": status, "mimetype": mimetype(style)}
+    except Exception as e:
+        logging.error("Error creating image for %s: %s" % (location, str(e)))
+        return {"location": location, "error": str(e)}
+
+def result_name(index, result):
+    return "%i.%s" % (index, "bin" if result["mimetype"] == "application/octet-stream" else "png")
+
+def result_manifest(results):
+    manifest = []
+    for index, result in enumerate(results):
+        if "error" in result:
+            manifest.append({"location": result["location"], "error": result["error"]})
+        else:
+            manifest.append({
+                "location": result["location"],
+                "file": result_name(index, result),
+                "etag": result["image"].etag,
+                "cache": result["status"],
+            })
+    return manifest
+
+def zip_body(results):
+    archive = BytesIO()
+    # PNGs and packed buffers are already compressed or tiny, so just store them
+    with zipfile.ZipFile(archive, "w", zipfile.ZIP_STORED) as zf:
+        zf.writestr("manifest.json", json.dumps(result_manifest(results)))
+        for index, result in enumerate(results):
+            if "error" not in result:
+                zf.writestr(result_name(index, result), result["image"].png)
+    headers = {"Content-Disposition": 'attachment; filename="weatherboard.zip"'}
+    return archive.getvalue(), "application/zip", headers
+
+def multipart_body(results):
+    boundary = uuid.uuid4().hex
+    body = BytesIO()
+    parts = [("application/json", "manifest.json", json.dumps(result_manifest(results)).encode())]
+    for index, result in enumerate(results):
+        if "error" not in result:
+            parts.append((result["mimetype"], result_name(index, result), result["image"].png))
+    for content_type, name, content in parts:
+        body.write(f"--{boundary}\r\n".encode())
+        body.write(f"Content-Type: {content_type}\r\n".encode())
+        body.write(f'Content-Disposition: attachment; filename="{name}"\r\n\r\n'.encode())
+        body.write(content)
+        body.write(b"\r\n")
+    body.write(f"--{boundary}--\r\n".encode())
+    return body.getvalue(), f"multipart/mixed; boundary={boundary}", {}
+
 @app.route("/health")
 def health():
-    return "OK"
\ No newline at end of file
+    return "OK"
+
+@app.route("/stats")
+def stats():
+    return jsonify(cache_stats())
+
+@app.route("/metrics")
+def prometheus_metrics():
+    return app.response_class(metrics.exposition(), mimetype=metrics.CONTENT_TYPE)
+
+def cache_stats():
+    return {
+        "onecall_cache": onecall_cache.stats(),
+        "geocode_cache": geocode_cache.cities.stats(),
+        "geocode_error_cache": geocode_cache.errors.stats(),
+        "render_cache": render_cache.entries.stats(),
+        "prefetch": prefetcher.stats(),
+    }
@@ -0,0 +1,42 @@
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Keep one warm connection per serving thread for each upstream host
+POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", "8"))
+DEFAULT_TIMEOUT = float(os.environ.get("HTTP_TIMEOUT", "10"))
+
+
+class TimeoutAdapter(HTTPAdapter):
+    """HTTPAdapter that applies DEFAULT_TIMEOUT when the caller gives none."""
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = DEFAULT_TIMEOUT
+        return super().send(request, **kwargs)
+
+
+retry = Retry(
+    total=2,
+    backoff_factor=0.3,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=frozenset(["GET"]),
+    raise_on_status=False,
+)
+
+# The adapter owns the connection pools and is safe to share between threads
+adapter = TimeoutAdapter(pool_connections=8, pool_maxsize=POOL_SIZE, max_retries=retry)
+
+local = threading.local()
+
+
+def session() -> requests.Session:
+    # Sessions keep cookie state and are not thread-safe, so each thread has its
+    # own, but they all share the pooled adapter
+    if not hasattr(local, "session"):
+        local.session = requests.Session()
+        local.session.mount("https://", adapter)
+        local.session.mount("http://", adapter)
+    return local.session
@@ -0,0 +1,134 @@
+import os
+import time
+import struct
+import hashlib
+import logging
+import threading
+import weakref
+
+# Fetched forecasts and rendered images are kept here so a restarted server starts warm; empty disables
+SNAPSHOT_DIR = os.environ.get(
+    "SNAPSHOT_DIR", os.path.join(os.path.dirname(__file__), "cache", "snapshots")
+)
+
+# Each store is swept of expired files every SNAPSHOT_SWEEP_INTERVAL seconds and then trimmed,
+# oldest first, to SNAPSHOT_MAX_BYTES
+SNAPSHOT_MAX_BYTES = int(os.environ.get("SNAPSHOT_MAX_BYTES", str(256 * 1024 * 1024)))
+SNAPSHOT_SWEEP_INTERVAL = int(os.environ.get("SNAPSHOT_SWEEP_INTERVAL", "600"))
+# Partial files older than this were left by a writer that died mid-write
+PARTIAL_MAX_AGE = 60
+
+# Every file starts with magic, format version and expiry (unix seconds), followed by the encoded value
+HEADER = struct.Struct("<4sBd")
+MAGIC = b"WBSN"
+VERSION = 2
+
+# Every live store, so one scheduled job can sweep them all
+stores = weakref.WeakSet()
+
+
+def sweep():
+    removed = sum(store.sweep() for store in list(stores))
+    if removed:
+        logging.info("Removed %i snapshots" % removed)
+    return removed
+
+
+class SnapshotStore:
+    """Values persisted one file per key with an expiry, read back only when asked for.
+
+    encode(value) -> bytes and decode(bytes) -> value are plain data formats, never pickle,
+    since the directory may be a shared volume.
+    """
+
+    def __init__(self, name, encode, decode, directory=SNAPSHOT_DIR, max_bytes=SNAPSHOT_MAX_BYTES):
+        self.directory = os.path.join(directory, name) if directory else None
+        self.encode = encode
+        self.decode = decode
+        self.max_bytes = max_bytes
+        stores.add(self)
+
+    def path(self, key):
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.directory, f"{digest}.bin")
+
+    def get(self, key):
+        """Return (value, expires), or None if there is no live snapshot for key."""
+        if self.directory is None:
+            return None
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                magic, version, expires = HEADER.unpack(f.read(HEADER.size))
+                if magic != MAGIC or version != VERSION or expires <= time.time():
+                    self.discard(path)
+                    return None
+                return self.decode(f.read()), expires
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            # A truncated file or one written by older code is only a cache miss
+            logging.warning("Could not read snapshot %s: %s" % (path, e))
+            self.discard(path)
+            return None
+
+    def set(self, key, value, ttl):
+        if self.directory is None:
+            return
+        path = self.path(key)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # Write then rename, so readers never see a half-written file
+            partial = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(partial, "wb") as f:
+                f.write(HEADER.pack(MAGIC, VERSION, time.time() + ttl))
+                f.write(self.encode(value))
+            os.replace(partial, path)
+        except OSError as e:
+            logging.warning("Could not write snapshot %s: %s" % (path, e))
+
+    def sweep(self):
+        """Remove expired, unreadable and abandoned files, then the oldest until under max_bytes."""
+        if self.directory is None:
+            return 0
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return 0
+        now = time.time()
+        removed = 0
+        live = []
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+                if name.endswith(".tmp"):
+                    dead = stat.st_mtime < now - PARTIAL_MAX_AGE
+                else:
+                    with open(path, "rb") as f:
+                        magic, version, expires = HEADER.unpack(f.read(HEADER.size))
+                    dead = magic != MAGIC or version != VERSION or expires <= now
+            except FileNotFoundError:
+                continue
+            except (OSError, struct.error):
+                dead = True
+            if dead:
+                self.discard(path)
+                removed += 1
+            elif not name.endswith(".tmp"):
+                live.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in live)
+        for _, size, path in sorted(live):
+            if total <= self.max_bytes:
+                break
+            self.discard(path)
+            total -= size
+            removed += 1
+        return removed
+
+    def discard(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
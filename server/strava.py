@@ -1,33 +1,109 @@
 import os
-import requests
+import time
+import asyncio
 import logging
+import metrics
+import threading
+import asynchttp
+from cache import Cache
+from sessions import session
+from cachetools import TTLCache
+
+# Refresh the access token this many seconds before Strava says it expires
+STRAVA_REFRESH_MARGIN = int(os.environ.get("STRAVA_REFRESH_MARGIN", "300"))
+STRAVA_STATS_TTL = int(os.environ.get("STRAVA_STATS_TTL", "900"))
+
+STRAVA_AUTH_URL = "https://www.strava.com/oauth/token"
+
+class StravaService:
+    # Shared by every instance so the token survives between renders
+    token_lock = threading.Lock()
+    async_token_lock = None
+    access_token = None
+    expires_at = 0
+    refresh_token = None
+    ytd_cache = Cache(TTLCache(maxsize=16, ttl=STRAVA_STATS_TTL))
 
-class StravaService:    
     def get_ride_ytd(self):
-        url = f'https://www.strava.com/api/v3/athletes/{os.environ.get("STRAVA_RIDER_ID")}/stats'
-        response = requests.get(url, headers = { "Authorization": f'Bearer {self.acquire_access_token()}'})
-        
-        if response.status_code != 200:
+        rider_id = os.environ.get("STRAVA_RIDER_ID")
+        distance = self.ytd_cache.get(rider_id)
+        if distance is not None:
+            return distance
+
+        token = self.acquire_access_token()
+        with metrics.timer(metrics.upstream_seconds, "strava"):
+            response = session().get(self.stats_url(rider_id), headers = { "Authorization": f'Bearer {token}'})
+        return self.parse_ride_ytd(rider_id, response.status_code, response.json())
+
+    async def get_ride_ytd_async(self):
+        rider_id = os.environ.get("STRAVA_RIDER_ID")
+        distance = self.ytd_cache.get(rider_id)
+        if distance is not None:
+            return distance
+
+        token = await self.acquire_access_token_async()
+        with metrics.timer(metrics.upstream_seconds, "strava"):
+            response = await asynchttp.get(self.stats_url(rider_id), headers = { "Authorization": f'Bearer {token}'})
+        return self.parse_ride_ytd(rider_id, response.status_code, response.json())
+
+    def stats_url(self, rider_id):
+        return f'https://www.strava.com/api/v3/athletes/{rider_id}/stats'
+
+    def parse_ride_ytd(self, rider_id, status_code, body):
+        if status_code != 200:
             logging.warning("something went wrong with strava api")
-            logging.warning(response.json())
+            logging.warning(body)
             return -1
         logging.info("strava api call successful")
-        return response.json()['ytd_ride_totals']['distance']
+        distance = body['ytd_ride_totals']['distance']
+        self.ytd_cache.set(rider_id, distance)
+        return distance
 
     def acquire_access_token(self):
-        auth_url = "https://www.strava.com/oauth/token"
+        # Only one thread refreshes; the others wait and reuse its token
+        with StravaService.token_lock:
+            if self.token_valid():
+                return StravaService.access_token
+            return self.refresh_access_token()
+
+    async def acquire_access_token_async(self):
+        # Created lazily so the lock belongs to the serving event loop
+        if StravaService.async_token_lock is None:
+            StravaService.async_token_lock = asyncio.Lock()
+        async with StravaService.async_token_lock:
+            if self.token_valid():
+                return StravaService.access_token
+            with metrics.timer(metrics.upstream_seconds, "strava_token"):
+                response = await asynchttp.post(STRAVA_AUTH_URL, data=self.refresh_payload())
+            return self.parse_token(response.status_code, response.json())
+
+    def token_valid(self):
+        return StravaService.access_token and time.time() < StravaService.expires_at - STRAVA_REFRESH_MARGIN
 
-        payload = {
+    def refresh_access_token(self):
+        with metrics.timer(metrics.upstream_seconds, "strava_token"):
+            response = session().post(STRAVA_AUTH_URL, data=self.refresh_payload())
+        return self.parse_token(response.status_code, response.json())
+
+    def refresh_payload(self):
+        return {
             "client_id": os.environ.get("STRAVA_CLIENT_ID"),
             "client_secret": os.environ.get("STRAVA_CLIENT_SECRET"),
             "grant_type": "refresh_token",
-            "refresh_token": os.environ.get("STRAVA_REFRESH_TOKEN"),
+            "refresh_token": StravaService.refresh_token or os.environ.get("STRAVA_REFRESH_TOKEN"),
         }
 
-        response = requests.post(auth_url, data=payload)
-        if response.status_code != 200:
+    def parse_token(self, status_code, token):
+        if status_code != 200:
             logging.warning("something went wrong with strava api")
-            logging.warning(response.json())
+            logging.warning(token)
             return -1
         logging.info("strava api call successful")
-        return response.json()['access_token']
+        StravaService.access_token = token['access_token']
+        StravaService.expires_at = token['expires_at']
+        # Strava may rotate the refresh token, so keep the newest one
+        StravaService.refresh_token = token.get('refresh_token', StravaService.refresh_token)
+        return StravaService.access_token
+
+
+metrics.register_cache("strava_ytd", StravaService.ytd_cache)
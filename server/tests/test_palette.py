@@ -0,0 +1,46 @@
+import numpy
+import pytest
+
+import palette
+
+
+@pytest.mark.parametrize("width, height", [(800, 480), (801, 481), (1, 1), (3, 2)])
+def test_pack_7color_two_pixels_per_byte(width, height):
+    indices = numpy.arange(width * height, dtype=numpy.uint8).reshape(height, width) % 7
+    packed = palette.pack(indices, "7color")
+
+    assert len(packed) == (width * height + 1) // 2
+    flat = indices.flatten()
+    assert packed[0] >> 4 == flat[0]
+    if flat.size % 2:
+        assert packed[-1] & 0x0F == 0
+    else:
+        assert packed[-1] & 0x0F == flat[-1]
+
+
+@pytest.mark.parametrize("width, height", [(400, 300), (801, 481), (3, 1)])
+def test_pack_3color_black_then_red_plane(width, height):
+    indices = numpy.zeros((height, width), dtype=numpy.uint8)
+    indices.flat[0] = 1  # black
+    indices.flat[-1] = 2  # red
+    packed = palette.pack(indices, "3color")
+
+    plane = (width * height + 7) // 8
+    assert len(packed) == 2 * plane
+    black, red = packed[:plane], packed[plane:]
+    assert black[0] >> 7 == 0  # 0 = black
+    assert red[0] >> 7 == 0
+    last = (width * height - 1) % 8
+    assert (red[-1] >> (7 - last)) & 1 == 1
+
+
+@pytest.mark.parametrize("name", list(palette.PALETTES))
+@pytest.mark.parametrize("dither", ["none", "floyd-steinberg"])
+def test_quantize_keeps_palette_colours(name, dither):
+    # Exact palette colours leave no error to diffuse, so every pixel maps to its own index
+    colours = palette.PALETTES[name]
+    rgb = numpy.array([colours], dtype=numpy.uint8).repeat(8, axis=0)
+    indices = palette.quantize(rgb, name, dither)
+
+    assert indices.shape == rgb.shape[:2]
+    assert (indices == numpy.arange(len(colours))).all()
@@ -0,0 +1,86 @@
+import os
+import time
+
+from snapshots import HEADER, SnapshotStore
+from imagecache import RenderCache, RenderedImage
+
+
+def store(tmp_path, name="test"):
+    return SnapshotStore(name, lambda value: value, lambda payload: payload, directory=str(tmp_path))
+
+
+def test_round_trip_keeps_value_and_expiry(tmp_path):
+    snapshots = store(tmp_path)
+    snapshots.set(("55.66", "12.59"), b"payload", 60)
+
+    value, expires = snapshots.get(("55.66", "12.59"))
+    assert value == b"payload"
+    assert time.time() < expires <= time.time() + 60
+
+
+def test_expired_snapshot_is_a_miss_and_removed(tmp_path):
+    snapshots = store(tmp_path)
+    snapshots.set("key", b"payload", -1)
+
+    assert snapshots.get("key") is None
+    assert not os.path.exists(snapshots.path("key"))
+
+
+def test_undecodable_snapshot_is_a_miss(tmp_path):
+    snapshots = SnapshotStore("test", bytes, lambda payload: payload.decode("ascii"), directory=str(tmp_path))
+    snapshots.set("key", b"\xff", 60)
+    assert snapshots.get("key") is None
+
+    with open(snapshots.path("truncated"), "wb") as f:
+        f.write(HEADER.pack(b"WB", 0, 0)[:5])
+    assert snapshots.get("truncated") is None
+
+
+def test_disabled_store_keeps_nothing():
+    snapshots = SnapshotStore("test", bytes, bytes, directory="")
+    snapshots.set("key", b"payload", 60)
+    assert snapshots.get("key") is None
+
+
+def test_sweep_removes_expired_and_abandoned_files(tmp_path):
+    snapshots = store(tmp_path)
+    snapshots.set("live", b"payload", 60)
+    snapshots.set("expired", b"payload", -1)
+    partial = snapshots.path("crashed") + ".1.2.tmp"
+    with open(partial, "wb") as f:
+        f.write(b"half")
+    os.utime(partial, (0, 0))
+
+    assert snapshots.sweep() == 2
+    assert os.listdir(snapshots.directory) == [os.path.basename(snapshots.path("live"))]
+
+
+def test_sweep_evicts_oldest_over_max_bytes(tmp_path):
+    snapshots = store(tmp_path)
+    for age, key in enumerate(["newest", "middle", "oldest"]):
+        snapshots.set(key, b"x" * 100, 60)
+        os.utime(snapshots.path(key), (1000 - age, 1000 - age))
+    snapshots.max_bytes = 2 * (HEADER.size + 100)
+
+    assert snapshots.sweep() == 1
+    assert snapshots.get("oldest") is None
+    assert snapshots.get("middle") is not None and snapshots.get("newest") is not None
+
+
+def test_rendered_image_round_trip():
+    image = RenderedImage(b"\x89PNG\r\n\x1a\n...", "0123abcd", bucket=42, last_modified=1700000000)
+    restored = RenderedImage.from_bytes(image.to_bytes())
+
+    assert (restored.png, restored.etag, restored.bucket) == (image.png, image.etag, image.bucket)
+    assert (restored.last_modified, restored.created) == (image.last_modified, image.created)
+
+
+def test_render_cache_restores_from_snapshot(tmp_path):
+    first = RenderCache()
+    first.snapshots = SnapshotStore("render", RenderedImage.to_bytes, RenderedImage.from_bytes, str(tmp_path))
+    first.store("key", lambda: (b"png", "etag"))
+
+    second = RenderCache()
+    second.snapshots = first.snapshots
+    image, status = second.lookup("key", None)
+    assert (image.png, image.etag, status) == (b"png", "etag", "HIT")
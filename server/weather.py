@@ -1,88 +1,395 @@
+import os
+import json
 import time
 import pytz
+import numpy
+import zlib
 import math
-import requests
+import hashlib
+import logging
+import threading
+import bisect
+import metrics
+import asyncio
+import asynchttp
+from cache import Cache
+from sessions import session
+from snapshots import SNAPSHOT_DIR, SnapshotStore
+from singleflight import SingleFlight, AsyncSingleFlight
 from datetime import datetime
+from cachetools import LRUCache, TLRUCache
+from typing import NamedTuple, Tuple
+
+# onecall payloads only change every ~10 minutes, so nearby boards share one fetch
+ONECALL_CACHE_TTL = int(os.environ.get("ONECALL_CACHE_TTL", "600"))
+ONECALL_CACHE_SIZE = int(os.environ.get("ONECALL_CACHE_SIZE", "256"))
+ONECALL_CACHE_PRECISION = int(os.environ.get("ONECALL_CACHE_PRECISION", "2"))
+
+# Entries are (forecast, expires), so one restored from disk keeps its original expiry
+onecall_cache = Cache(
+    TLRUCache(maxsize=ONECALL_CACHE_SIZE, ttu=lambda key, entry, now: entry[1], timer=time.time)
+)
+onecall_flights = SingleFlight()
+onecall_async_flights = AsyncSingleFlight()
+metrics.register_cache("onecall", onecall_cache)
+# Local-time summaries keyed by (forecast, timezone), so cached forecasts aren't re-summarised per render
+summary_cache = Cache(LRUCache(maxsize=ONECALL_CACHE_SIZE))
+metrics.register_cache("summaries", summary_cache)
+
+OCEAN_URL = "http://api.weather.kols.dk/oceanObs/30363"
+
+
+class VerifiedKeys:
+    """api keys OpenWeatherMap has accepted; cached forecasts (and images) are only shared with these.
+
+    Only a sha256 of each key is kept, in memory and in a file next to the snapshots,
+    so a restarted server can serve snapshots to known boards without asking upstream first.
+    """
+
+    def __init__(self, directory=SNAPSHOT_DIR):
+        self.path = os.path.join(directory, "verified_keys") if directory else None
+        self.digests = set()
+        self.lock = threading.Lock()
+        if self.path is not None:
+            try:
+                with open(self.path) as f:
+                    self.digests.update(line.strip() for line in f if line.strip())
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logging.warning("Could not read verified keys %s: %s" % (self.path, e))
+
+    def digest(self, api_key):
+        return hashlib.sha256(api_key.encode()).hexdigest()
+
+    def __contains__(self, api_key):
+        return self.digest(api_key) in self.digests
+
+    def add(self, api_key):
+        digest = self.digest(api_key)
+        with self.lock:
+            if digest in self.digests:
+                return
+            self.digests.add(digest)
+            if self.path is None:
+                return
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                with open(self.path, "a") as f:
+                    f.write(digest + "\n")
+            except OSError as e:
+                logging.warning("Could not write verified keys %s: %s" % (self.path, e))
+
+
+verified_keys = VerifiedKeys()
+
+
+# Only the onecall fields we draw, as immutable tuples that are cheap to cache, hash and pickle
+class Hour(NamedTuple):
+    dt: int
+    temp: float
+    rain: float
+    snow: float
+    uvi: float
+    wind_speed: float
+    wind_deg: float
+    clouds: int
+    code: int
+    description: str
+
+
+class Day(NamedTuple):
+    date: datetime
+    temp_min: float
+    temp_max: float
+    uvi: float
+    wind_speed: float
+    code: int
+    description: str
+
+
+class Alert(NamedTuple):
+    event: str
+    end: int
+
+
+class Forecast(NamedTuple):
+    current_time: int
+    temp: float
+    uvi: float
+    pressure: float
+    wind_speed: float
+    sunrise: datetime
+    sunset: datetime
+    hourly: Tuple[Hour, ...]  # sorted by dt
+    daily: Tuple[Day, ...]
+    alerts: Tuple[Alert, ...]
+
+
+# What the board draws for one hour or day, in the board's timezone
+class HourSummary(NamedTuple):
+    time: datetime
+    hour: str
+    day: str
+    icon: str
+    description: str
+    temperature: float
+    wind: float  # in m/s
+    wind_icon: str
+    rain: float
+    snow: float
+    clouds: int
+    uv: float
+
+
+class DaySummary(NamedTuple):
+    date: datetime
+    icon: str
+    description: str
+    temperature_range: Tuple[float, float]
+    wind: float
+
+
+class Summaries(NamedTuple):
+    hourly_times: Tuple[int, ...]
+    hourly: Tuple[HourSummary, ...]
+    daily: Tuple[DaySummary, ...]
+    # Per hour (temp, rain, snow, uvi) rows and local day, for the meteogram to index into
+    hourly_series: numpy.ndarray
+    hourly_days: numpy.ndarray
+
+
+def parse_forecast(data) -> Forecast:
+    current = data["current"]
+    hourly = sorted(data["hourly"], key=lambda hour: hour["dt"])
+    return Forecast(
+        current_time=current["dt"],
+        temp=current["temp"],
+        uvi=current["uvi"],
+        pressure=current["pressure"],
+        wind_speed=current["wind_speed"],
+        sunrise=datetime.fromtimestamp(current["sunrise"], pytz.utc),
+        sunset=datetime.fromtimestamp(current["sunset"], pytz.utc),
+        hourly=tuple(
+            Hour(
+                dt=hour["dt"],
+                temp=hour["temp"],
+                rain=hour.get("rain", {}).get("1h", 0),
+                snow=hour.get("snow", {}).get("1h", 0),
+                uvi=hour["uvi"],
+                wind_speed=hour["wind_speed"], # in m/s
+                wind_deg=hour["wind_deg"],
+                clouds=hour["clouds"],
+                code=hour["weather"][0]["id"],
+                description=hour["weather"][0]["main"].title(),
+            )
+            for hour in hourly
+        ),
+        daily=tuple(
+            Day(
+                date=datetime.fromtimestamp(day["dt"], pytz.utc),
+                temp_min=day["temp"]["min"],
+                temp_max=day["temp"]["max"],
+                uvi=day["uvi"],
+                wind_speed=day["wind_speed"],
+                code=day["weather"][0]["id"],
+                description=day["weather"][0]["main"].title(),
+            )
+            for day in data["daily"]
+        ),
+        alerts=tuple(Alert(event=alert["event"], end=alert["end"]) for alert in data.get("alerts", [])),
+    )
+
+
+def encode_forecast(forecast: Forecast) -> bytes:
+    # NamedTuples become JSON arrays in field order, datetimes unix seconds
+    return zlib.compress(json.dumps(forecast, default=lambda value: value.timestamp()).encode())
+
+
+def decode_forecast(payload: bytes) -> Forecast:
+    current_time, temp, uvi, pressure, wind_speed, sunrise, sunset, hourly, daily, alerts = json.loads(
+        zlib.decompress(payload)
+    )
+    return Forecast(
+        current_time=current_time,
+        temp=temp,
+        uvi=uvi,
+        pressure=pressure,
+        wind_speed=wind_speed,
+        sunrise=datetime.fromtimestamp(sunrise, pytz.utc),
+        sunset=datetime.fromtimestamp(sunset, pytz.utc),
+        hourly=tuple(Hour(*hour) for hour in hourly),
+        daily=tuple(Day(datetime.fromtimestamp(day[0], pytz.utc), *day[1:]) for day in daily),
+        alerts=tuple(Alert(*alert) for alert in alerts),
+    )
+
+
+# Survives restarts; a forecast restored from disk is only used until its original TTL runs out
+onecall_snapshots = SnapshotStore("onecall", encode_forecast, decode_forecast)
+
 
 class WeatherClient:
-    def __init__(self, latitude, longitude, timezone=None):
+    def __init__(self, latitude, longitude, timezone=None, units="metric"):
         self.latitude = float(latitude)
         self.longitude = float(longitude)
         self.timezone = timezone
+        self.units = units
+
+    def load(self, api_key, timeout=None):
+        key, url = self.onecall_request(api_key)
+        self.forecast = self.cached(key, api_key)
+        if self.forecast is None and api_key in verified_keys:
+            self.forecast = self.restore(key)
+        if self.forecast is None:
+            self.forecast = onecall_flights.do(
+                self.flight_key(key, api_key), lambda: self.fetch(key, url, api_key, timeout)
+            )
+        self.index()
+
+    async def load_async(self, api_key, timeout=None):
+        key, url = self.onecall_request(api_key)
+        self.forecast = self.cached(key, api_key)
+        if self.forecast is None and api_key in verified_keys:
+            # Reading the snapshot blocks, so keep it off the event loop
+            self.forecast = await asyncio.get_running_loop().run_in_executor(None, self.restore, key)
+        if self.forecast is None:
+            self.forecast = await onecall_async_flights.do(
+                self.flight_key(key, api_key), lambda: self.fetch_async(key, url, api_key, timeout)
+            )
+        self.index()
+
+    def cached(self, key, api_key):
+        # An untested key goes upstream, so a bad one can't read what good ones fetched
+        if api_key not in verified_keys:
+            return None
+        entry = onecall_cache.get(key)
+        return entry[0] if entry is not None else None
 
-    def load(self, api_key):
-        url = f"https://api.openweathermap.org/data/3.0/onecall?lat={self.latitude}&lon={self.longitude}&exclude=minutely&units=metric&appid={api_key}"
-        self.data = requests.get(url).json()
-        self.current_time = self.data["current"]["dt"]
+    def restore(self, key):
+        entry = onecall_snapshots.get(key)
+        if entry is None:
+            return None
+        onecall_cache.set(key, entry)
+        return entry[0]
 
+    def flight_key(self, key, api_key):
+        return key if api_key in verified_keys else (key, api_key)
+
+    def onecall_request(self, api_key):
+        # Quantize so every board within the cache precision maps to the same payload
+        lat = round(self.latitude, ONECALL_CACHE_PRECISION)
+        lon = round(self.longitude, ONECALL_CACHE_PRECISION)
+        url = f"https://api.openweathermap.org/data/3.0/onecall?lat={lat}&lon={lon}&exclude=minutely&units={self.units}&appid={api_key}"
+        return (lat, lon, self.units), url
+
+    @metrics.timed(metrics.upstream_seconds, "onecall")
+    def fetch(self, key, url, api_key, timeout):
+        return self.store(key, api_key, session().get(url, timeout=timeout).json())
+
+    @metrics.timed_async(metrics.upstream_seconds, "onecall")
+    async def fetch_async(self, key, url, api_key, timeout):
+        data = (await asynchttp.get(url, timeout=timeout)).json()
+        # store writes the snapshot to disk, so keep it off the event loop
+        return await asyncio.get_running_loop().run_in_executor(None, self.store, key, api_key, data)
+
+    def store(self, key, api_key, data):
+        # Error payloads (bad key, quota) have no "current" and are never cached
+        if "current" not in data:
+            raise ValueError("Unexpected onecall response: %s" % data.get("message", data))
+        verified_keys.add(api_key)
+        forecast = parse_forecast(data)
+        onecall_cache.set(key, (forecast, time.time() + ONECALL_CACHE_TTL))
+        onecall_snapshots.set(key, forecast, ONECALL_CACHE_TTL)
+        return forecast
+
+    def index(self):
+        self.current_time = self.forecast.current_time
+        self.summaries = summary_cache.get_or_create((self.forecast, self.timezone), self.summarise)
+        self.hourly_times = self.summaries.hourly_times
+        self.hourly_summaries = self.summaries.hourly
+
+    def summarise(self) -> Summaries:
+        # Every hour and day once per forecast and timezone, so lookups are a bisect or an index
+        hourly = tuple(self.summarise_hour(hour) for hour in self.forecast.hourly)
+        return Summaries(
+            hourly_times=tuple(hour.dt for hour in self.forecast.hourly),
+            hourly=hourly,
+            daily=tuple(self.summarise_day(day) for day in self.forecast.daily),
+            hourly_series=numpy.array(
+                [(hour.temp, hour.rain, hour.snow, hour.uvi) for hour in self.forecast.hourly], dtype=float
+            ),
+            hourly_days=numpy.array([summary.day for summary in hourly]),
+        )
 
     def temp_current(self):
-        return self.data["current"]["temp"]
+        return self.forecast.temp
 
     def uvi_max_today(self):
-        return self.data["daily"][0]["uvi"]
+        return self.forecast.daily[0].uvi
 
     def uvi_current(self):
-        return self.data["current"]["uvi"]
+        return self.forecast.uvi
 
     def pressure_current(self):
-        return self.data["current"]["pressure"]
+        return self.forecast.pressure
     
     def wind_speed_current(self):
-        return self.data["current"]["wind_speed"]
+        return self.forecast.wind_speed
 
     def sunrise(self):
-        return datetime.fromtimestamp(self.data["current"]["sunrise"], pytz.utc)
+        return self.forecast.sunrise
 
     def sunset(self):
-        return datetime.fromtimestamp(self.data["current"]["sunset"], pytz.utc)
+        return self.forecast.sunset
 
-    def hourly_summary(self, time_offset):
-        # Find the right hour
+    def hourly_summary(self, time_offset) -> HourSummary:
+        # Find the hour the target time falls within
         target = time.time() + time_offset
-        for d1, d2 in zip(self.data["hourly"], self.data["hourly"][1:]):
-            if d1["dt"] < target < d2["dt"]:
-                break
-        data = d1
-        # Format a summary
-        dt = datetime.fromtimestamp(data["dt"], pytz.utc)
-        hour = dt.astimezone(self.timezone).strftime("%H")
+        index = bisect.bisect_right(self.hourly_times, target) - 1
+        index = min(max(index, 0), len(self.hourly_summaries) - 1)
+        return self.hourly_summaries[index]
+
+    def summarise_hour(self, data: Hour) -> HourSummary:
+        dt = datetime.fromtimestamp(data.dt, pytz.utc)
+        local = dt.astimezone(self.timezone)
+        hour = local.strftime("%H")
         if hour == "":
             hour = "0"
 
-        return {
-            "time": dt,
-            "hour": hour,
-            "day": dt.astimezone(self.timezone).strftime("%d").lstrip("0"),
-            "icon": self.code_to_icon(data["weather"][0]["id"], data["uvi"] == 0),
-            "description": data["weather"][0]["main"].title(),
-            "temperature": data["temp"],
-            "wind": data["wind_speed"], # in m/s
-            "wind-icon": self.wind_deg_to_icon(data["wind_deg"]),
-            "rain": data.get("rain", {}).get("1h", 0),
-            "snow": data.get("snow", {}).get("1h", 0),
-            "clouds": data["clouds"],
-            "uv": data["uvi"],
-        }
-
-    def daily_summary(self, day_offset):
-        data = self.data["daily"][day_offset]
-        # Format a summary
-        return {
-            "date": datetime.fromtimestamp(data["dt"], pytz.utc),
-            "icon": self.code_to_icon(data["weather"][0]["id"]),
-            "description": data["weather"][0]["main"].title(),
-            "temperature_range": (data["temp"]["min"], data["temp"]["max"]),
-            "wind": data["wind_speed"],
-        }
+        return HourSummary(
+            time=dt,
+            hour=hour,
+            day=local.strftime("%d").lstrip("0"),
+            icon=self.code_to_icon(data.code, data.uvi == 0),
+            description=data.description,
+            temperature=data.temp,
+            wind=data.wind_speed,
+            wind_icon=self.wind_deg_to_icon(data.wind_deg),
+            rain=data.rain,
+            snow=data.snow,
+            clouds=data.clouds,
+            uv=data.uvi,
+        )
+
+    def daily_summary(self, day_offset) -> DaySummary:
+        return self.summaries.daily[day_offset]
+
+    def summarise_day(self, data: Day) -> DaySummary:
+        return DaySummary(
+            date=data.date,
+            icon=self.code_to_icon(data.code),
+            description=data.description,
+            temperature_range=(data.temp_min, data.temp_max),
+            wind=data.wind_speed,
+        )
 
     def active_alerts(self):
         result = []
-        for alert in self.data.get("alerts", []):
-            hours_left = math.ceil((alert["end"] - time.time()) / 3600)
+        for alert in self.forecast.alerts:
+            hours_left = math.ceil((alert.end - time.time()) / 3600)
             result.append(
                 {
-                    "text": alert["event"],
+                    "text": alert.event,
                     "subtext": (
                         "for %i hours" % hours_left
                         if hours_left != 1
@@ -92,16 +399,23 @@ class WeatherClient:
             )
         return result
     
-    def ocean_temp(self):
+    @metrics.timed(metrics.upstream_seconds, "ocean")
+    def ocean_temp(self, timeout=None):
         try:
-            ocean_observation = requests.get(
-                f"http://api.weather.kols.dk/oceanObs/30363"
-            ).json()
+            ocean_observation = session().get(OCEAN_URL, timeout=timeout).json()
             max_temp = ocean_observation["observation"]["maxTemp24H"]
             return max_temp
         except:
             return 'N/A'
 
+    @metrics.timed_async(metrics.upstream_seconds, "ocean")
+    async def ocean_temp_async(self, timeout=None):
+        try:
+            ocean_observation = (await asynchttp.get(OCEAN_URL, timeout=timeout)).json()
+            return ocean_observation["observation"]["maxTemp24H"]
+        except:
+            return 'N/A'
+
     def wind_deg_to_icon(self, deg):
         if deg < 22.5 or deg >= 337.5:
             return "arrow-down"